@@ -1,65 +1,155 @@
+import numpy as np
+
+
+AA1 = "ARNDCEQGHILKMFPSTWYV"
+# decoding alphabet, index 20 is the unknown residue
+AA1_ALPHABET = AA1 + "X"
+AA3 = np.array(["ALA", "ARG", "ASN", "ASP", "CYS", "GLU", "GLN", "GLY", "HIS", "ILE",
+                "LEU", "LYS", "MET", "PHE", "PRO", "SER", "THR", "TRP", "TYR", "VAL", "ASX", "GLX"])
+AA3_AA1 = np.array(list(AA1 + "BZ"))
+
+
+def make_byte_table(letters, extra=None):
+    # 256-entry lookup from ASCII code to residue index, -1 for anything not in letters or extra
+    table = np.full(256, -1, dtype=np.int8)
+    for i, c in enumerate(letters):
+        table[ord(c.upper())] = i
+        table[ord(c.lower())] = i
+    if extra is not None:
+        for c, i in extra.items():
+            table[ord(c.upper())] = i
+            table[ord(c.lower())] = i
+    return table
+
+
+AA1_TABLE = make_byte_table(AA1)
+# the encoding a2id has always used, which reads X as V
+A2ID_TABLE = make_byte_table(AA1, extra=dict(X=19))
+AA3_ORDER = np.argsort(AA3)
+
+
+def encode_seq(seq, unknown=None, table=AA1_TABLE, dtype=np.int64):
+    # unknown=None raises KeyError on residues missing from table, otherwise they are encoded as unknown
+    if isinstance(seq, str):
+        seq = seq.encode("ascii", errors="replace")
+    ids = table[np.frombuffer(seq, dtype=np.uint8)]
+    bad = ids < 0
+    if np.any(bad):
+        if unknown is None:
+            raise KeyError("unknown residues {}".format(sorted(set(np.frombuffer(seq, dtype="S1")[bad].astype(str)))))
+        ids = np.where(bad, unknown, ids)
+    return ids.astype(dtype)
+
+
+def encode_seqs(seqs, unknown=None, table=AA1_TABLE, dtype=np.int64):
+    # a whole collection of sequences (e.g. a df "seq" column) in one lookup: flat codes plus n+1 offsets
+    seqs = list(seqs)
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in seqs])
+    codes = encode_seq("".join(seqs), unknown=unknown, table=table, dtype=dtype)
+    return codes, offsets
+
+
+def decode_seq(ids):
+    return np.frombuffer(AA1_ALPHABET.encode(), dtype="S1")[np.asarray(ids, dtype=np.int64)].tobytes().decode()
+
+
+def decode_seqs(codes, offsets):
+    seq = decode_seq(codes)
+    return [seq[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+def aa3_index(names):
+    # position of every 3-letter code in AA3 and whether it is missing from it
+    names = np.char.upper(np.asarray(names, dtype=str))
+    ids = AA3_ORDER[np.clip(np.searchsorted(AA3[AA3_ORDER], names), 0, len(AA3) - 1)]
+    return ids, AA3[ids] != names, names
+
+
+def encode_aa3(names, unknown=None, dtype=np.int64):
+    # 3-letter codes to residue indices; ASX and GLX count as unknown
+    ids, bad, names = aa3_index(names)
+    bad = np.logical_or(bad, ids >= len(AA1))
+    if np.any(bad):
+        if unknown is None:
+            raise KeyError("unknown residues {}".format(sorted(set(names[bad].ravel()))))
+        ids = np.where(bad, unknown, ids)
+    return ids.astype(dtype)
+
+
+def aa3_to_aa1_array(names, unknown=None):
+    ids, bad, names = aa3_index(names)
+    letters = AA3_AA1[ids]
+    if np.any(bad):
+        if unknown is None:
+            raise KeyError("unknown residues {}".format(sorted(set(names[bad].ravel()))))
+        letters = np.where(bad, unknown, letters)
+    return letters
+
+
+def aa1_to_aa3_array(letters):
+    letters = np.char.upper(np.asarray(letters, dtype=str))
+    match = letters.reshape(-1, 1) == AA3_AA1.reshape(1, -1)
+    if not np.all(np.any(match, axis=1)):
+        raise KeyError("unknown residues {}".format(sorted(set(letters.ravel()[~np.any(match, axis=1)]))))
+    return AA3[np.argmax(match, axis=1)]
+
+
+def encode_one(c, table=AA1_TABLE):
+    if len(c) != 1:
+        raise KeyError(c)
+    return int(encode_seq(c, table=table)[0])
+
+
 def aaa2id(aa):
-    table = dict(ALA=0, ARG=1, ASN=2, ASP=3, CYS=4, GLN=5, GLU=6, GLY=7, HIS=8,
-                 ILE=9, LEU=10, LYS=11, MET=12, PHE=13, PRO=14, SER=15, THR=16,
-                 TRP=17, TYR=18, VAL=19)
-    return table[aa.upper()]
+    # the ids aaa2id has always returned, which have GLN and GLU the other way round from a2id/id2a and encode_aa3;
+    # kept so that data encoded with it keeps its meaning. aa3_to_id agrees with the rest
+    i = aa3_to_id(aa)
+    return {5: 6, 6: 5}.get(i, i)
+
+
+def aa3_to_id(aa):
+    return int(encode_aa3([aa])[0])
 
 
 def a2id(aa):
-    table = dict(A=0, R=1, N=2, D=3, C=4, E=5, Q=6, G=7, H=8,
-                 I=9, L=10, K=11, M=12, F=13, P=14, S=15, T=16,
-                 W=17, Y=18, V=19, X=19)
-    return table[aa.upper()]
+    return encode_one(aa, table=A2ID_TABLE)
 
 
 def id2a(aid):
-    table = ["A", "R", "N", "D", "C", "E", "Q", "G", "H", "I",
-             "L", "K", "M", "F", "P", "S", "T", "W", "Y", "V",
-             "X"]
-    return table[aid]
+    return AA1_ALPHABET[aid]
 
 
 def aa3toaa1(x):
-    table = dict(ala="A", arg="R", asn="N", asp="D", asx="B", cys="C", glu="E", gln="Q", glx="Z",
-                 gly="G", his="H", ile="I", leu="L", lys="K", met="M", phe="F", pro="P", ser="S",
-                 thr="T", trp="W", tyr="Y", val="V")
     if isinstance(x, str):
-        return table[x.lower()]
+        return str(aa3_to_aa1_array([x])[0])
     if isinstance(x, list):
-        return [table[i.lower()] for i in x]
+        return [str(c) for c in aa3_to_aa1_array(x)]
 
 
 def aa1toaa3(x):
-    table = dict(a="ALA", r="ARG", n="ASN", d="asp", b="asx", c="cys", e="glu", q="gln", z="glx",
-                 g="gly", h="his", i="ile", l="leu", k="lys", m="met", f="phe", p="pro", s="ser",
-                 t="thr", w="trp", y="tyr", v="val")
     if isinstance(x, str):
-        return table[x.lower()].upper()
+        return str(aa1_to_aa3_array([x])[0])
     if isinstance(x, list):
-        return [table[i.lower()].upper() for i in x]
+        return [str(c) for c in aa1_to_aa3_array(x)]
 
 
 def aa1toidx(x):
-    table = dict(A=0, R=1, N=2, D=3, C=4, E=5, Q=6, G=7, H=8, I=9,
-                 L=10, K=11, M=12, F=13, P=14, S=15, T=16, W=17, Y=18, V=19)
     if isinstance(x, str):
-        return table[x.upper()]
+        return encode_one(x)
     if isinstance(x, list):
-        return [table[i.upper()] for i in x]
-    
+        return [encode_one(i) for i in x]
+
 
 def aa3toidx(x):
     return aa1toidx(aa3toaa1(x))
 
 
 def idxtoaa1(idx):
-    table = ["A", "R", "N", "D", "C", "E", "Q", "G", "H", "I",
-             "L", "K", "M", "F", "P", "S", "T", "W", "Y", "V",
-             "X"]
     if isinstance(idx, int):
-        return table[idx]
+        return AA1_ALPHABET[idx]
     if isinstance(idx, list):
-        return [table[i] for i in idx]
+        return list(decode_seq(idx))
 
 
 def idxtoaa3(idx):
@@ -0,0 +1,259 @@
+import os
+import sys
+import math
+import json
+import time
+import platform
+import argparse
+from multiprocessing import Pool
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from dataset import GCNDataset, make_contact_map, make_a_matrix, make_d_matrix
+from decoder import Decoder
+from lstm_utils import parse_pdb
+from networks import GeneratorLSTM
+from telemetry import peak_rss_mb, reset_peak_rss, rss_mb
+
+
+def random_chain(n, rn, step=3.8):
+    # C-alpha trace of a random walk with residue spacing `step` in Angstrom
+    steps = rn.randn(n, 3)
+    steps = step * steps / np.linalg.norm(steps, axis=1, keepdims=True)
+    return np.cumsum(steps, axis=0)
+
+
+def pdb_lines(n, rn):
+    lines = list()
+    coors = random_chain(n, rn)
+    k = 1
+    for i in range(n):
+        for atom, shift in ((" N  ", -1.0), (" CA ", 0.0), (" C  ", 1.0), (" O  ", 1.5)):
+            x, y, z = coors[i] + shift
+            lines.append("ATOM  {:5d} {:4s} ALA A{:4d}    {:8.3f}{:8.3f}{:8.3f}{:6.2f}{:6.2f}           {}\n".format(
+                k, atom, i + 1, x, y, z, 1.0, 20.0, atom.strip()[0]))
+            k += 1
+    return lines
+
+
+def make_model(size, args):
+    # the default untiled scoring path below score_mem_from; from there on the untiled activations of the scoring
+    # cases would need several GB, so pairs are scored in tiles under the budget
+    budget = None
+    if args.score_mem_mb is not None and size >= args.score_mem_from:
+        budget = int(args.score_mem_mb * 2 ** 20)
+    return GeneratorLSTM(n_lstm_hidden=args.n_lstm_hidden, n_node_embed=args.n_node_embed,
+                         n_graph_layers=args.n_graph_layers, score_mem_budget=budget)
+
+
+def model_inputs(size, rn):
+    n = size // 2
+    x = torch.from_numpy(np.eye(20)[rn.randint(0, 20, n)]).float()
+    f = torch.from_numpy(rn.rand(size, 20)).float()
+    a_mat = make_a_matrix(rn.permutation(size))
+    return x, f, torch.from_numpy(a_mat).float(), torch.from_numpy(make_d_matrix(a_mat)).float()
+
+
+# every setup function prepares the inputs for one protein size and returns the callable being timed
+
+def setup_contact_map(size, rn, args):
+    coors = random_chain(size, rn) * 100
+    mask = rn.rand(size) < 0.95
+    return lambda: make_contact_map(coors * 0.01, mask)
+
+
+def setup_a_matrix(size, rn, args):
+    idxs = rn.permutation(size)
+    return lambda: make_d_matrix(make_a_matrix(idxs))
+
+
+def setup_gcn(size, rn, args):
+    model = make_model(size, args)
+    _, f, a_tensor, d_tensor = model_inputs(size, rn)
+    h = torch.rand(size, args.n_node_embed)
+
+    def run():
+        with torch.no_grad():
+            model.gcn(a_tensor, d_tensor, h)
+    return run
+
+
+def setup_forward(size, rn, args):
+    model = make_model(size, args).eval()
+    inputs = model_inputs(size, rn)
+
+    def run():
+        with torch.no_grad():
+            model(*inputs)
+    return run
+
+
+def setup_build_one(size, rn, args):
+    dataset = GCNDataset(args.repeat + 1, size, None, seq_len_range=(size // 2, size // 2 + 1), seed=0,
+                         build_on_the_fly=True)
+    return lambda: dataset.build_one(0)
+
+
+def setup_getitem(size, rn, args):
+    dataset = GCNDataset(args.repeat + 1, size, None, seq_len_range=(size // 2, size // 2 + 1), seed=0,
+                         build_on_the_fly=True)
+    return lambda: dataset[0]
+
+
+def setup_parse_pdb(size, rn, args):
+    lines = pdb_lines(size, rn)
+    return lambda: parse_pdb(lines)
+
+
+def setup_train_step(size, rn, args):
+    model = make_model(size, args).train()
+    optimizer = optim.Adam(model.parameters(), lr=0.01)
+    loss_fn = nn.CrossEntropyLoss()
+    inputs = model_inputs(size, rn)
+    g_tensor = torch.from_numpy(rn.permutation(size)[:size // 2]).long()
+
+    def run():
+        model.zero_grad()
+        scores, _ = model(*inputs)
+        loss = torch.min(loss_fn(scores, g_tensor), loss_fn(scores, torch.flip(g_tensor, (0, ))))
+        loss.backward()
+        optimizer.step()
+    return run
+
+
+def decoder_inputs(size, rn):
+    # scores of size // 2 residues with their true nodes favoured, and a graph chaining the true nodes in order
+    n = size // 2
+    gt_idxs = rn.permutation(size)[:n]
+    scores = rn.randn(n, size)
+    scores[np.arange(n), gt_idxs] += 2.5
+    pos = size + 2 * np.arange(size)
+    pos[gt_idxs] = np.arange(n)
+    return torch.from_numpy(scores).float(), make_a_matrix(pos, sparse=True)
+
+
+def setup_decode_assign(size, rn, args):
+    scores, _ = decoder_inputs(size, rn)
+    decoder = Decoder("assign")
+    return lambda: decoder(scores)
+
+
+def setup_decode_beam(size, rn, args):
+    scores, a_mat = decoder_inputs(size, rn)
+    decoder = Decoder("beam", continuity=True)
+    return lambda: decoder(scores, a_mat)
+
+
+BENCHMARKS = dict(contact_map=setup_contact_map, a_matrix=setup_a_matrix, gcn_forward=setup_gcn,
+                  model_forward=setup_forward, build_one=setup_build_one, getitem=setup_getitem,
+                  parse_pdb=setup_parse_pdb, train_step=setup_train_step, decode_assign=setup_decode_assign,
+                  decode_beam=setup_decode_beam)
+def run_case(job):
+    # runs in a fresh worker process so that the peak RSS belongs to this case only. the worker inherits the
+    # parent's resident memory, so the peak is reported above the RSS right after the reset. like timeit, fast
+    # cases are called `number` times per timed run so that a run lasts at least min_time
+    name, size, args = job
+    torch.manual_seed(args.seed)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    rn = np.random.RandomState(args.seed)
+    reset_peak_rss()
+    base_rss = rss_mb()
+    run = BENCHMARKS[name](size, rn, args)
+    t0 = time.perf_counter()
+    run()
+    number = max(1, int(math.ceil(args.min_time / max(time.perf_counter() - t0, 1e-9))))
+    times = list()
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            run()
+        times.append((time.perf_counter() - t0) / number)
+    wall = float(np.median(times))
+    return dict(name=name, size=size, wall_s=wall, min_wall_s=float(np.min(times)), samples_per_s=1.0 / wall,
+                peak_rss_mb=peak_rss_mb() - base_rss, base_rss_mb=base_rss, repeat=args.repeat, number=number)
+
+
+def run_all(args):
+    results = list()
+    for name in args.benchmarks:
+        for size in args.sizes:
+            with Pool(1, maxtasksperchild=1) as pool:
+                result = pool.apply(run_case, ((name, size, args), ))
+            print("{:14s} {:5d}  {:9.4f}s  {:10.1f}/s  {:8.1f}MB".format(
+                name, size, result["wall_s"], result["samples_per_s"], result["peak_rss_mb"]))
+            results.append(result)
+    meta = dict(python=platform.python_version(), numpy=np.__version__, torch=torch.__version__,
+                machine=platform.machine(), processor=platform.processor(), cpus=os.cpu_count(),
+                threads=args.threads if args.threads is not None else torch.get_num_threads(),
+                n_lstm_hidden=args.n_lstm_hidden, n_node_embed=args.n_node_embed,
+                n_graph_layers=args.n_graph_layers, score_mem_mb=args.score_mem_mb,
+                score_mem_from=args.score_mem_from, min_time=args.min_time, seed=args.seed,
+                time=time.strftime("%Y-%m-%d %H:%M:%S"))
+    return dict(meta=meta, results=results)
+
+
+def compare(report, baseline, tolerance, min_delta_ms=1.0, min_delta_mb=16.0):
+    # a case regresses when its median wall time or peak RSS exceeds the baseline by more than tolerance and by more
+    # than min_delta_ms / min_delta_mb, below which the differences are noise
+    min_delta = dict(wall_s=min_delta_ms / 1000.0, peak_rss_mb=min_delta_mb)
+    base = {(r["name"], r["size"]): r for r in baseline["results"]}
+    regressions = list()
+    for r in report["results"]:
+        b = base.get((r["name"], r["size"]))
+        if b is None:
+            continue
+        for key in ("wall_s", "peak_rss_mb"):
+            ratio = r[key] / max(b[key], 1e-12)
+            flag = ratio > 1 + tolerance and r[key] - b[key] > min_delta[key]
+            print("{:14s} {:5d}  {:11s} {:10.4f} -> {:10.4f}  x{:.2f}{}".format(
+                r["name"], r["size"], key, b[key], r[key], ratio, "  REGRESSION" if flag else ""))
+            if flag:
+                regressions.append(dict(name=r["name"], size=r["size"], metric=key, baseline=b[key], value=r[key]))
+    return regressions
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Benchmark the pipeline's hot paths across protein sizes")
+    p.add_argument("--benchmarks", "-b", type=str, nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS),
+                   help="Benchmarks to run")
+    p.add_argument("--sizes", type=int, nargs="+", default=[128, 256, 512, 1024, 2048, 4096],
+                   help="Candidate buffer sizes; sequences are half as long")
+    p.add_argument("--repeat", "-r", type=int, default=3, help="Timed runs per case after one warm-up run")
+    p.add_argument("--min_time", type=float, default=0.05,
+                   help="Repeat fast cases within a timed run until it lasts this many seconds")
+    p.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    p.add_argument("--n_lstm_hidden", type=int, default=256, help="Dimenion of LSTM hidden states")
+    p.add_argument("--n_node_embed", type=int, default=128, help="Dimenion of node embeddings")
+    p.add_argument("--n_graph_layers", type=int, default=1, help="Number of layers in GCN")
+    p.add_argument("--score_mem_mb", type=float, default=256,
+                   help="Scoring memory budget of the model in MB from --score_mem_from on, smaller sizes are untiled")
+    p.add_argument("--score_mem_from", type=int, default=4096, help="Smallest size scored in tiles under the budget")
+    p.add_argument("--seed", type=int, default=2020, help="Random seed")
+    p.add_argument("--output", "-o", type=str, default=None, help="Write results to this JSON file")
+    p.add_argument("--compare", type=str, default=None, help="Baseline JSON file to compare against")
+    p.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown before flagging")
+    p.add_argument("--min_delta_ms", type=float, default=1.0, help="Smallest wall time increase flagged, in ms")
+    p.add_argument("--min_delta_mb", type=float, default=16.0, help="Smallest peak RSS increase flagged, in MB")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    report = run_all(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.loads(f.read())
+        regressions = compare(report, baseline, args.tolerance, min_delta_ms=args.min_delta_ms,
+                              min_delta_mb=args.min_delta_mb)
+        print("{} regressions".format(len(regressions)))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import numpy as np
+import torch
+from scipy.sparse import coo_matrix, csr_matrix, identity
+from scipy.spatial import cKDTree
+
+
+# nearest candidate nodes of every candidate node, as an (m, k) array with the node itself first and -1 padding,
+# for GeneratorLSTM.forward_topk. with C-alpha coordinates the neighbours come from a k-d tree; without them, from
+# hop distance in the contact graph the model already gets, whose edges are spatial contacts
+
+
+def graph_csr(a_mat):
+    # sparsity pattern of a dense, scipy or torch (dense or sparse COO) adjacency as a boolean CSR matrix
+    if torch.is_tensor(a_mat):
+        if a_mat.is_sparse:
+            a_mat = a_mat.coalesce()
+            rows, cols = a_mat.indices().cpu().numpy()
+            return csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=tuple(a_mat.size()))
+        a_mat = a_mat.cpu().numpy()
+    return csr_matrix(coo_matrix(a_mat), dtype=bool)
+
+
+def knn_coors(coors, k):
+    # candidates without coordinates (NaN) only have themselves as a neighbour and are nobody else's
+    coors = np.asarray(coors, dtype=np.float64)
+    m = len(coors)
+    k = min(k, m)
+    nbrs = np.full((m, k), -1, dtype=np.int64)
+    nbrs[:, 0] = np.arange(m)
+    valid = np.flatnonzero(np.all(np.isfinite(coors), axis=1))
+    kv = min(k, len(valid))
+    if kv < 2:
+        return nbrs
+    _, found = cKDTree(coors[valid]).query(coors[valid], k=kv)
+    # the node itself goes first; where duplicate coordinates pushed it out of the query, the farthest one is dropped
+    others = found != np.arange(len(valid)).reshape(-1, 1)
+    others[np.all(others, axis=1), -1] = False
+    nbrs[valid, 1:kv] = valid[found[others].reshape(len(valid), kv - 1)]
+    return nbrs
+
+
+def knn_graph(a_mat, k, max_hops=None):
+    # breadth-first over the whole graph at once: reach holds the nodes within h hops of every node, new those at
+    # exactly h hops. nodes stop expanding once they reached k others, so the search goes on until every node has
+    # k neighbours or its component is exhausted (or after max_hops). ties within a hop are broken by node index
+    a = graph_csr(a_mat)
+    m = a.shape[0]
+    reach = identity(m, dtype=bool, format="csr")
+    frontier = reach
+    found = [(np.arange(m), np.arange(m), np.zeros(m, dtype=np.int64))]
+    h = 0
+    while max_hops is None or h < max_hops:
+        h += 1
+        frontier = csr_matrix(frontier.multiply((reach.getnnz(axis=1) < k).reshape(-1, 1)), dtype=bool)
+        new = ((frontier @ a) != 0) > reach
+        if new.nnz == 0:
+            break
+        new = new.tocoo()
+        found.append((new.row, new.col, np.full(new.nnz, h)))
+        reach = (reach + new).tocsr()
+        frontier = new.tocsr()
+    rows, cols, hops = [np.concatenate(v) for v in zip(*found)]
+    order = np.lexsort((cols, hops, rows))
+    rows = rows[order]
+    cols = cols[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = rank < k
+    nbrs = np.full((m, k), -1, dtype=np.int64)
+    nbrs[rows[keep], rank[keep]] = cols[keep]
+    return nbrs
@@ -1,49 +1,243 @@
 import os
+import glob
+import json
+import time
+from multiprocessing import Pool
 import numpy as np
-import pandas as pd
 import h5py
-from torch.utils.data import Dataset
+import torch
+from scipy.sparse import coo_matrix, csr_matrix, diags
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 from aa_code_utils import *
+from graph_cache import GraphCache
+from sample_store import SampleStore, SampleStoreWriter, SAMPLE_FIELDS
+from distributed import rank, world_size
 
 
-def onehot(x):
-    z = np.zeros((len(x), 20))
-    for i, c in enumerate(x):
-        z[i, c] = 1
-    return z
+def onehot(x, dtype=np.float64):
+    return np.eye(20, dtype=dtype)[x]
 
 
-def make_contact_map(ca_coors, mask=None, cutoff=4):
-    # print("ca_coors", ca_coors.shape)
-    print("ca_coors max", np.max(ca_coors), "ca_coors min", np.min(ca_coors))
-    dist_map = np.linalg.norm(ca_coors[np.newaxis, :, :] - ca_coors[:, np.newaxis, :], axis=2)
-    cont_map = dist_map < cutoff
+def find_contacts(ca_coors, cutoff=4):
+    # cell list: bin atoms into cubes with edge `cutoff` so only the 27 surrounding cells need to be searched
+    ca_coors = np.asarray(ca_coors, dtype=np.float64)
+    valid = np.flatnonzero(np.all(np.isfinite(ca_coors), axis=1))
+    if len(valid) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    coors = ca_coors[valid]
+    cells = np.floor((coors - np.min(coors, axis=0)) / cutoff).astype(np.int64) + 1
+    dims = np.max(cells, axis=0) + 2
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    rows = list()
+    cols = list()
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                nb_keys = keys + (dx * dims[1] + dy) * dims[2] + dz
+                start = np.searchsorted(sorted_keys, nb_keys, side="left")
+                counts = np.searchsorted(sorted_keys, nb_keys, side="right") - start
+                total = int(np.sum(counts))
+                if total == 0:
+                    continue
+                i = np.repeat(np.arange(len(coors)), counts)
+                offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                j = order[np.repeat(start, counts) + offsets]
+                keep = np.sum((coors[i] - coors[j]) ** 2, axis=1) < cutoff ** 2
+                rows.append(valid[i[keep]])
+                cols.append(valid[j[keep]])
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+def make_contact_map(ca_coors, mask=None, cutoff=4, sparse=False, verbose=False):
+    n = len(ca_coors)
+    if verbose:
+        print("ca_coors max", np.nanmax(ca_coors), "ca_coors min", np.nanmin(ca_coors))
+    rows, cols = find_contacts(ca_coors, cutoff=cutoff)
     if mask is not None:
-        cont_map[~mask, :] = False
-        cont_map[:, ~mask] = False
-        cont_map[~mask, ~mask] = True
-    print("{0} contacts in the {1}x{1} contact map".format(np.sum(1.0*cont_map)-cont_map.shape[0], cont_map.shape[0]))
-    return cont_map
+        mask = np.asarray(mask, dtype=bool)
+        keep = np.logical_and(mask[rows], mask[cols])
+        loops = np.flatnonzero(~mask)
+        rows = np.concatenate((rows[keep], loops))
+        cols = np.concatenate((cols[keep], loops))
+    cont_map = coo_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n, n)).tocsr()
+    if verbose:
+        print("{0} contacts in the {1}x{1} contact map".format(cont_map.nnz - n, n))
+    if sparse:
+        return cont_map
+    return cont_map.toarray()
 
 
-def make_a_matrix(idxs, self_loop=True):
-    mat = (np.repeat(idxs.reshape(-1, 1), idxs.shape[0], 1) - np.repeat(idxs.reshape(1, -1), idxs.shape[0], 0))
-    mat = 1.0 * (abs(mat) == 1)
+def make_a_matrix(idxs, self_loop=True, sparse=False, dtype=np.float64):
+    if sparse:
+        n = len(idxs)
+        order = np.argsort(idxs)
+        chain = np.flatnonzero(np.diff(idxs[order]) == 1)
+        rows = np.concatenate((order[chain], order[chain + 1]))
+        cols = np.concatenate((order[chain + 1], order[chain]))
+        if self_loop:
+            rows = np.concatenate((rows, np.arange(n)))
+            cols = np.concatenate((cols, np.arange(n)))
+        return coo_matrix((np.ones(len(rows), dtype=dtype), (rows, cols)), shape=(n, n)).tocsr()
+    mat = (np.abs(idxs.reshape(-1, 1) - idxs.reshape(1, -1)) == 1).astype(dtype)
     if self_loop:
-        mat = mat + np.eye(len(idxs))
+        # the diagonal is zero, |i - i| != 1
+        np.fill_diagonal(mat, 1)
     return mat
 
 
 def make_d_matrix(a_mat):
-    mat = np.eye(a_mat.shape[0]) * np.sum(a_mat, axis=1) ** (-0.5)
+    mat = np.eye(a_mat.shape[0], dtype=a_mat.dtype) * np.sum(a_mat, axis=1) ** (-0.5)
     return mat
 
 
+def make_norm_a_matrix(a_mat):
+    # D^-1/2 A D^-1/2, the propagation matrix GCN.forward would otherwise rebuild on every pass
+    a_mat = csr_matrix(a_mat, dtype=np.float64)
+    d = diags(np.asarray(a_mat.sum(axis=1)).ravel() ** (-0.5))
+    return (d @ a_mat @ d).tocoo()
+
+
+def contacts_from_coo(rows, cols, n, sparse=False, dtype=np.float64):
+    cont_map = coo_matrix((np.ones(len(rows), dtype=dtype), (rows, cols)), shape=(n, n)).tocsr()
+    if sparse:
+        return cont_map
+    return cont_map.toarray()
+
+
+def float32_tensor(v):
+    # read-only (memory-mapped) or non-float32 arrays are copied once, anything else is wrapped as is
+    return torch.from_numpy(np.require(v, dtype=np.float32, requirements="W"))
+
+
+def tensor_sample(x, f, a_mat, d_mat, gt_idxs):
+    # a sample as float32 torch tensors that the model consumes without conversion; returned from DataLoader
+    # workers they travel through shared memory instead of being pickled
+    return (float32_tensor(x), float32_tensor(f), a_mat if torch.is_tensor(a_mat) else float32_tensor(a_mat),
+            None if d_mat is None else float32_tensor(d_mat),
+            torch.from_numpy(np.require(gt_idxs, dtype=np.int64, requirements="W")))
+
+
+def sparse_to_tensor(mat):
+    mat = mat.tocoo()
+    indices = torch.from_numpy(np.vstack((mat.row, mat.col)).astype(np.int64))
+    values = torch.from_numpy(mat.data.astype(np.float32))
+    return torch.sparse_coo_tensor(indices, values, mat.shape, check_invariants=False).coalesce()
+
+
+def collate_graphs(batch):
+    # sequences are padded to (n_max, B, 20), node features stacked and the per-sample normalized adjacencies
+    # combined into one block-diagonal sparse matrix; padded targets are -1
+    x_lens = torch.tensor([len(item[0]) for item in batch])
+    f_lens = torch.tensor([len(item[1]) for item in batch])
+    x = pad_sequence([torch.as_tensor(item[0]) for item in batch])
+    f = torch.cat([torch.as_tensor(item[1]) for item in batch])
+    indices = list()
+    values = list()
+    offset = 0
+    for (_, _, a_mat, d_mat, _), m in zip(batch, f_lens.tolist()):
+        if d_mat is not None:
+            a_mat = sparse_to_tensor(make_norm_a_matrix(np.asarray(a_mat)))
+        elif not torch.is_tensor(a_mat):
+            a_mat = sparse_to_tensor(coo_matrix(a_mat))
+        elif not a_mat.is_sparse:
+            a_mat = a_mat.to_sparse()
+        indices.append(a_mat.indices() + offset)
+        values.append(a_mat.values())
+        offset += m
+    a_mat = torch.sparse_coo_tensor(torch.cat(indices, 1), torch.cat(values), (offset, offset),
+                                    check_invariants=False).coalesce()
+    gt_idxs = pad_sequence([torch.as_tensor(item[4]) for item in batch], batch_first=True, padding_value=-1)
+    gt_idxs_rev = pad_sequence([torch.flip(torch.as_tensor(item[4]), (0, )) for item in batch], batch_first=True,
+                               padding_value=-1)
+    return x, x_lens, f, f_lens, a_mat, gt_idxs, gt_idxs_rev
+
+
+def sample_seed(seed, idx):
+    return int(np.random.SeedSequence((seed, idx)).generate_state(1)[0])
+
+
+build_dataset = None
+
+
+def init_build_worker(dataset):
+    global build_dataset
+    build_dataset = dataset
+
+
+def build_shard(job):
+    start, stop, shard = job
+    samples = [build_dataset.build_seeded(i) for i in range(start, stop)]
+    if shard is None:
+        return start, stop, samples
+    tmp = "{}.tmp".format(shard)
+    with SampleStoreWriter(tmp, fields=build_dataset.fields) as writer:
+        for sample in samples:
+            writer.append(build_dataset.record(sample))
+    os.replace(tmp, shard)
+    return start, stop, None
+
+
+def assemble_sample(rn, my_seq, my_a_mat, max_buf_size, seq_len_range, verbose=False):
+    # candidate nodes, noisy one-hot features and ground truth for an encoded sequence. without a contact map the
+    # buffer is padded to max_buf_size with decoy nodes and shuffled, and the graph is the chain through my_idxs
+    my_seq_len = len(my_seq)
+    my_seq_idxs = np.arange(my_seq_len)
+    if verbose:
+        print("my_seq_idxs", my_seq_idxs.shape)
+    if my_a_mat is None:
+        my_dummy_idxs = rn.permutation(np.arange(seq_len_range[1], 2 * max_buf_size))[0:(max_buf_size - my_seq_len)]
+        if verbose:
+            print("my_dummy_idxs", my_dummy_idxs.shape)
+        my_rand_idxs = rn.permutation(max_buf_size)
+        if verbose:
+            print("my_rand_idxs", my_rand_idxs.shape)
+        my_idxs = np.concatenate((my_seq_idxs, my_dummy_idxs))[my_rand_idxs]
+        if verbose:
+            print("my_idxs", my_idxs.shape)
+        my_seq = np.concatenate((my_seq, rn.randint(0, 20, max_buf_size - my_seq_len)))
+        my_seq = my_seq[my_rand_idxs]
+    else:
+        my_idxs = my_seq_idxs
+    my_feats = 0.01 * abs(rn.randn(len(my_seq), 20))
+    my_gt_idxs = np.argsort(my_idxs)[0:my_seq_len]
+    my_gt_seq = my_seq[my_gt_idxs]
+    rows = np.arange(len(my_seq))
+    my_feats[rows, my_seq] = 1 - np.sum(my_feats, axis=1) + my_feats[rows, my_seq]
+    return my_idxs, my_feats, my_seq, my_gt_seq, my_gt_idxs, my_a_mat
+
+
+def graph_sample(my_idxs, f, my_gt_seq, gt_idxs, a_mat=None, sparse=False, float32=False):
+    # model inputs of one sample: chain graph from my_idxs unless a contact map is given. float32 builds the
+    # matrices in float32 and returns tensors (see tensor_sample)
+    dtype = np.float32 if float32 else np.float64
+    x = onehot(my_gt_seq, dtype=dtype)
+    if a_mat is None:
+        a_mat = make_a_matrix(my_idxs, sparse=sparse, dtype=dtype)
+    if sparse:
+        sample = x, f, sparse_to_tensor(make_norm_a_matrix(a_mat)), None, gt_idxs
+    else:
+        a_mat = np.asarray(a_mat, dtype=dtype)
+        sample = x, f, a_mat, make_d_matrix(a_mat), gt_idxs
+    return tensor_sample(*sample) if float32 else sample
+
+
 class GCNDataset(Dataset):
 
     def __init__(self, n, max_buf_size, df_path, seq_len_range=(128, 512), seed=0, h5=None, build_on_the_fly=False,
+                 sparse_adjacency=False, build_batch_size=None, h5_format="datasets", h5_compression=None, mmap=False,
+                 cutoff=4, graph_cache=None, n_build_workers=None, shard_size=10000, float32_tensors=False,
                  verbose=False):
         self.rn = np.random.RandomState(seed)
+        self.seed = seed
+        self.cutoff = cutoff
+        self.graph_cache = graph_cache
+        self.n_build_workers = n_build_workers
+        self.shard_size = shard_size
         self.n = n
         self.verbose = verbose
         self.df_path = df_path
@@ -51,7 +245,14 @@ class GCNDataset(Dataset):
         self.max_buf_size = max_buf_size
         self.seq_len_range = seq_len_range
         self.build_on_the_fly = build_on_the_fly
+        self.sparse_adjacency = sparse_adjacency
+        # samples as float32 tensors instead of float64 arrays
+        self.float32_tensors = float32_tensors
+        self.dtype = np.float32 if float32_tensors else np.float64
+        self.build_batch_size = build_batch_size
         if self.df_path:
+            # pandas is only needed here, so jobs that read prepared sample files never import it
+            import pandas as pd
             self.df = pd.read_hdf(self.df_path, "df").query("len >= {} and len <= {}".format(*self.seq_len_range))
             if "standard" in self.df:
                 self.df = self.df.query("standard")
@@ -64,7 +265,11 @@ class GCNDataset(Dataset):
             print(self.df["len"].describe())
         else:
             self.use_df_data = False
+        self.has_contacts = self.use_df_data and "CA_coors" in self.df
+        # contact maps are kept as COO row/col pairs next to the other fields
+        self.fields = SAMPLE_FIELDS + ("a_rows", "a_cols") if self.has_contacts else SAMPLE_FIELDS
         if h5 is None:
+            self.a_mat = list()
             self.idxs = list()
             self.f = list()
             self.seq = list()
@@ -73,97 +278,360 @@ class GCNDataset(Dataset):
             self.h5_filename = None
             self.h5_mode = False
         else:
-            self.h5_filename = os.path.join(h5, "gcn_lstm_{}_{}_{}_{}_{}.h5".format(max_buf_size, seq_len_range[0],
-                                                                                    seq_len_range[1], n, seed))
+            # h5_format "datasets" stores five datasets per sample, "ragged" one SampleStore file. h5 is a directory
+            # for a file named after the build parameters, or the .h5 file itself
+            prefix = "gcn_lstm_store" if h5_format == "ragged" else "gcn_lstm"
+            if h5.endswith(".h5"):
+                self.h5_filename = h5
+            else:
+                self.h5_filename = os.path.join(h5, "{}_{}_{}_{}_{}_{}.h5".format(
+                    prefix, max_buf_size, seq_len_range[0], seq_len_range[1], n, seed))
             self.h5_mode = True
+        self.h5_format = h5_format
+        self.h5_compression = h5_compression
+        self.mmap = mmap
+        self.h5_handle = None
+        self.h5_pid = None
         if self.build_on_the_fly:
             pass
         else:
             self.build_all()
-        if self.h5_mode:
+
+    def open_h5(self):
+        # opened lazily so that every DataLoader worker gets its own handle
+        if self.h5_pid == os.getpid():
+            return self.h5_handle
+        if self.h5_format == "ragged":
+            self.h5_handle = SampleStore(self.h5_filename, fields=self.fields, mmap=self.mmap)
+        else:
             self.h5_handle = h5py.File(self.h5_filename, "r")
+        self.h5_pid = os.getpid()
+        return self.h5_handle
 
     def build_one(self, idx):
         my_a_mat = None
-        make_dummy = True
         if self.use_df_data:
-            my_seq_len = self.df["len"].iloc[idx]
-            my_seq = np.array([a2id(c) for c in self.df["seq"].iloc[idx]])
+            my_seq = encode_seq(self.df["seq"].iloc[idx], table=A2ID_TABLE)
             if "CA_coors" in self.df:
                 my_a_mat = 1.0 * make_contact_map(self.df["CA_coors"].iloc[idx] * 0.01,
-                                                  self.df["mask"].iloc[idx])
+                                                  self.df["mask"].iloc[idx], cutoff=self.cutoff,
+                                                  sparse=self.sparse_adjacency, verbose=self.verbose)
                 if self.verbose:
                     print("contact map created", my_a_mat.shape)
-                make_dummy = False
         else:
             my_seq_len = self.rn.randint(self.seq_len_range[0], self.seq_len_range[1])
             my_seq = self.rn.randint(0, 20, my_seq_len)
-        my_seq_idxs = np.arange(my_seq_len)
-        if self.verbose:
-            print("my_seq_idxs", my_seq_idxs.shape)
-        if make_dummy:
-            my_dummy_idxs = self.rn.permutation(np.arange(self.seq_len_range[1], 2 * self.max_buf_size))[
-                            0:(self.max_buf_size - my_seq_len)]
-            if self.verbose:
-                print("my_dummy_idxs", my_dummy_idxs.shape)
-            my_rand_idxs = self.rn.permutation(self.max_buf_size)
-            if self.verbose:
-                print("my_rand_idxs", my_rand_idxs.shape)
-            my_idxs = np.concatenate((my_seq_idxs, my_dummy_idxs))[my_rand_idxs]
-            if self.verbose:
-                print("my_idxs", my_idxs.shape)
-            my_seq = np.concatenate((my_seq, self.rn.randint(0, 20, self.max_buf_size - my_seq_len)))
-            my_seq = my_seq[my_rand_idxs]
+        return assemble_sample(self.rn, my_seq, my_a_mat, self.max_buf_size, self.seq_len_range,
+                               verbose=self.verbose)
+
+    def build_batch(self, n):
+        # simulated samples only: the same recipe as build_one, drawn for n samples at once
+        lo, hi = self.seq_len_range
+        m = self.max_buf_size
+        seq_lens = self.rn.randint(lo, hi, n)
+        seqs = self.rn.randint(0, 20, (n, m))
+        dummy_pool = np.arange(hi, 2 * m)[np.argsort(self.rn.rand(n, 2 * m - hi), axis=1)]
+        cols = np.arange(m).reshape(1, -1)
+        dummy_cols = np.clip(cols - seq_lens.reshape(-1, 1), 0, None)
+        idxs = np.where(cols < seq_lens.reshape(-1, 1), cols, np.take_along_axis(dummy_pool, dummy_cols, axis=1))
+        rand_idxs = np.argsort(self.rn.rand(n, m), axis=1)
+        idxs = np.take_along_axis(idxs, rand_idxs, axis=1)
+        seqs = np.take_along_axis(seqs, rand_idxs, axis=1)
+        feats = 0.01 * abs(self.rn.randn(n, m, 20))
+        rows = np.arange(n).reshape(-1, 1)
+        feats[rows, cols, seqs] = 1 - np.sum(feats, axis=2) + feats[rows, cols, seqs]
+        gt_idxs = np.argsort(idxs, axis=1)
+        samples = list()
+        for k in range(n):
+            my_gt_idxs = gt_idxs[k, :seq_lens[k]]
+            samples.append((idxs[k], feats[k], seqs[k], seqs[k, my_gt_idxs], my_gt_idxs, None))
+        return samples
+
+    def build_seeded(self, idx):
+        # every sample draws from its own stream so the result does not depend on how the build is split up
+        self.rn = np.random.RandomState(sample_seed(self.seed, idx))
+        return self.build_one(idx)
+
+    def record(self, sample):
+        my_idxs, my_feats, my_seq, my_gt_seq, my_gt_idxs, my_a_mat = sample
+        if self.has_contacts:
+            my_a_mat = coo_matrix(my_a_mat)
+            return my_idxs, my_feats, my_seq, my_gt_seq, my_gt_idxs, my_a_mat.row, my_a_mat.col
+        return my_idxs, my_feats, my_seq, my_gt_seq, my_gt_idxs
+
+    def write_record(self, handle, i, record):
+        if self.h5_format == "ragged":
+            handle.append(record)
         else:
-            my_idxs = my_seq_idxs
-        my_feats = 0.01 * abs(self.rn.randn(len(my_seq), 20))
-        my_gt_idxs = np.argsort(my_idxs)[0:my_seq_len]
-        my_gt_seq = my_seq[my_gt_idxs]
-        for j, s in enumerate(my_seq):
-            my_feats[j, s] = 1 - np.sum(my_feats[j, :]) + my_feats[j, s]
-        return my_idxs, my_feats, my_seq, my_gt_seq, my_gt_idxs, my_a_mat
+            for k, v in zip(self.fields, record):
+                handle.create_dataset("{}_{}".format(k, i), v.shape, data=v)
+
+    def append_sample(self, sample):
+        my_idxs, my_feats, my_seq, my_gt_seq, my_gt_idxs, my_a_mat = sample
+        self.a_mat.append(my_a_mat)
+        self.idxs.append(my_idxs)
+        self.f.append(my_feats)
+        self.seq.append(my_seq)
+        self.gt_seq.append(my_gt_seq)
+        self.gt_idxs.append(my_gt_idxs)
+
+    def open_writer(self):
+        if self.h5_format == "ragged":
+            return SampleStoreWriter(self.h5_filename, fields=self.fields, compression=self.h5_compression)
+        return h5py.File(self.h5_filename, "w")
 
     def build_all(self):
+        if self.n_build_workers is not None:
+            return self.build_parallel()
         if self.h5_mode:
-            handle = h5py.File(self.h5_filename, "w")
-        for i in range(self.n):
-            my_idxs, my_feats, my_seq, my_gt_seq, my_gt_idxs, my_a_mat = self.build_one(i)
-            if self.h5_mode:
-                handle.create_dataset("idxs_{}".format(i), my_idxs.shape, data=my_idxs)
-                handle.create_dataset("f_{}".format(i), my_feats.shape, data=my_feats)
-                handle.create_dataset("seq_{}".format(i), my_seq.shape, data=my_seq)
-                handle.create_dataset("gt_seq_{}".format(i), my_gt_seq.shape, data=my_gt_seq)
-                handle.create_dataset("gt_idxs_{}".format(i), my_gt_idxs.shape, data=my_gt_idxs)
+            handle = self.open_writer()
+        t0 = time.time()
+        i = 0
+        while i < self.n:
+            if self.build_batch_size and not self.use_df_data:
+                samples = self.build_batch(min(self.build_batch_size, self.n - i))
             else:
-                self.idxs.append(my_idxs)
-                self.f.append(my_feats)
-                self.seq.append(my_seq)
-                self.gt_seq.append(my_gt_seq)
-                self.gt_idxs.append(my_gt_idxs)
-            if (i+1) % 10000 == 0:
-                print("processed {} sequences".format(i+1))
+                samples = [self.build_one(i)]
+            for sample in samples:
+                if self.h5_mode:
+                    self.write_record(handle, i, self.record(sample))
+                else:
+                    self.append_sample(sample)
+                if (i+1) % 10000 == 0:
+                    print("processed {} sequences, {:.1f} samples/s".format(i+1, (i+1) / (time.time() - t0)))
+                i += 1
         if self.h5_mode:
             handle.close()
+        if self.n > 0:
+            print("built {} samples in {:.1f}s, {:.1f} samples/s".format(self.n, time.time() - t0,
+                                                                      self.n / max(time.time() - t0, 1e-9)))
+
+    def shard_manifest(self):
+        # build parameters that the shards of an interrupted build must share with this one to be reused
+        return dict(n=self.n, seed=self.seed, shard_size=self.shard_size, max_buf_size=self.max_buf_size,
+                    seq_len_range=list(self.seq_len_range), df_path=self.df_path, cutoff=self.cutoff,
+                    fields=list(self.fields))
+
+    def check_shards(self):
+        # shards left by a build with other parameters are removed, and the parameters of this one recorded
+        manifest_file = "{}.shards.json".format(self.h5_filename)
+        manifest = self.shard_manifest()
+        previous = None
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                previous = json.load(f)
+        if previous != manifest:
+            stale = glob.glob("{}.shard*[0-9]".format(glob.escape(self.h5_filename)))
+            if len(stale) > 0:
+                print("removing {} shards of a build with other parameters".format(len(stale)))
+            for shard in stale:
+                os.remove(shard)
+            with open(manifest_file, "w") as f:
+                json.dump(manifest, f)
+        return manifest_file
+
+    def build_parallel(self):
+        # shards of shard_size samples are built by a process pool; in h5 mode every finished shard is kept on disk
+        # as a SampleStore file until the merge, so an interrupted build with the same parameters picks up from the
+        # shards already there
+        t0 = time.time()
+        jobs = list()
+        n_done = 0
+        n_shards = (self.n + self.shard_size - 1) // self.shard_size
+        manifest_file = self.check_shards() if self.h5_mode else None
+        for k, start in enumerate(range(0, self.n, self.shard_size)):
+            stop = min(start + self.shard_size, self.n)
+            shard = "{}.shard{:05d}".format(self.h5_filename, k) if self.h5_mode else None
+            if shard is not None and os.path.exists(shard):
+                n_done += stop - start
+            else:
+                jobs.append((start, stop, shard))
+        if n_done > 0:
+            print("resuming build, {} samples found in finished shards".format(n_done))
+        n_resumed = n_done
+        shards = dict()
+        with Pool(max(1, self.n_build_workers), initializer=init_build_worker, initargs=(self, )) as pool:
+            for start, stop, result in pool.imap_unordered(build_shard, jobs):
+                shards[start] = result
+                n_done += stop - start
+                print("built {}/{} samples, {:.1f} samples/s".format(
+                    n_done, self.n, (n_done - n_resumed) / max(time.time() - t0, 1e-9)))
+        if self.h5_mode:
+            handle = self.open_writer()
+            shard_files = ["{}.shard{:05d}".format(self.h5_filename, k) for k in range(n_shards)]
+            i = 0
+            for shard in shard_files:
+                store = SampleStore(shard, fields=self.fields)
+                for j in range(len(store)):
+                    self.write_record(handle, i, store[j])
+                    i += 1
+                store.close()
+            handle.close()
+            for shard in shard_files:
+                os.remove(shard)
+            os.remove(manifest_file)
+        else:
+            for start in sorted(shards):
+                for sample in shards[start]:
+                    self.append_sample(sample)
+        print("built {} samples in {:.1f}s".format(self.n, time.time() - t0))
 
     def __len__(self):
         return self.n
 
     def __getitem__(self, idx):
         a_mat = None
-        if self.build_on_the_fly:
+        if self.build_on_the_fly and self.n_build_workers is not None:
+            my_idxs, f, my_seq, my_gt_seq, gt_idxs, a_mat = self.build_seeded(idx)
+        elif self.build_on_the_fly:
             my_idxs, f, my_seq, my_gt_seq, gt_idxs, a_mat = self.build_one(idx)
+        elif self.h5_mode and self.h5_format == "ragged":
+            store = self.open_h5()
+            my_gt_seq = store.get(idx, "gt_seq")
+            my_idxs = store.get(idx, "idxs")
+            f = store.get(idx, "f")
+            gt_idxs = store.get(idx, "gt_idxs")
+            if self.has_contacts:
+                a_mat = contacts_from_coo(store.get(idx, "a_rows"), store.get(idx, "a_cols"), len(my_idxs),
+                                          sparse=self.sparse_adjacency, dtype=self.dtype)
         elif self.h5_mode:
-            my_gt_seq = self.h5_handle["gt_seq_{}".format(idx)][()]
-            my_idxs = self.h5_handle["idxs_{}".format(idx)][()]
-            f = self.h5_handle["f_{}".format(idx)][()]
-            gt_idxs = self.h5_handle["gt_idxs_{}".format(idx)][()]
+            handle = self.open_h5()
+            my_gt_seq = handle["gt_seq_{}".format(idx)][()]
+            my_idxs = handle["idxs_{}".format(idx)][()]
+            f = handle["f_{}".format(idx)][()]
+            gt_idxs = handle["gt_idxs_{}".format(idx)][()]
+            if self.has_contacts:
+                a_mat = contacts_from_coo(handle["a_rows_{}".format(idx)][()], handle["a_cols_{}".format(idx)][()],
+                                          len(my_idxs), sparse=self.sparse_adjacency, dtype=self.dtype)
         else:
             my_gt_seq = self.gt_seq[idx]
             my_idxs = self.idxs[idx]
             f = self.f[idx]
             gt_idxs = self.gt_idxs[idx]
-        x = onehot(my_gt_seq)
-        if a_mat is None:
-            a_mat = make_a_matrix(my_idxs)
-        d_mat = make_d_matrix(a_mat)
-        return x, f, a_mat, d_mat, gt_idxs
+            a_mat = self.a_mat[idx]
+        if self.graph_cache is not None:
+            sample = (onehot(my_gt_seq, dtype=self.dtype), f) + \
+                self.cached_adjacency(idx, my_idxs, a_mat) + (gt_idxs, )
+            return tensor_sample(*sample) if self.float32_tensors else sample
+        return graph_sample(my_idxs, f, my_gt_seq, gt_idxs, a_mat, sparse=self.sparse_adjacency,
+                            float32=self.float32_tensors)
+
+    def cached_adjacency(self, idx, my_idxs, a_mat=None):
+        # chain graphs are fully determined by my_idxs, contact maps by the df row they were built from
+        key = GraphCache.key(self.df_path, self.cutoff, self.max_buf_size, tuple(self.seq_len_range), self.seed,
+                             self.n, idx if self.has_contacts else None, np.asarray(my_idxs))
+        a_norm = self.graph_cache.get(key)
+        if a_norm is None:
+            if a_mat is None:
+                a_mat = make_a_matrix(my_idxs, sparse=True)
+            a_norm = make_norm_a_matrix(a_mat)
+            self.graph_cache.put(key, a_norm)
+        if self.sparse_adjacency:
+            return sparse_to_tensor(a_norm), None
+        if self.float32_tensors:
+            return a_norm.astype(np.float32).toarray(), None
+        return a_norm.toarray(), None
+
+
+class PreparedDataset(Dataset):
+    # samples from a ragged SampleStore file written by GCNDataset (h5_format="ragged"), e.g. by
+    # `generator.py build-data`, without the sequence df or any of the build parameters
+
+    def __init__(self, filename, sparse_adjacency=False, mmap=False, float32_tensors=False):
+        self.filename = filename
+        self.sparse_adjacency = sparse_adjacency
+        self.float32_tensors = float32_tensors
+        self.dtype = np.float32 if float32_tensors else np.float64
+        with h5py.File(filename, "r") as handle:
+            self.has_contacts = "a_rows_offsets" in handle
+        fields = SAMPLE_FIELDS + ("a_rows", "a_cols") if self.has_contacts else SAMPLE_FIELDS
+        self.store = SampleStore(filename, fields=fields, mmap=mmap)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, idx):
+        my_idxs = self.store.get(idx, "idxs")
+        a_mat = None
+        if self.has_contacts:
+            a_mat = contacts_from_coo(self.store.get(idx, "a_rows"), self.store.get(idx, "a_cols"), len(my_idxs),
+                                      sparse=self.sparse_adjacency, dtype=self.dtype)
+        return graph_sample(my_idxs, self.store.get(idx, "f"), self.store.get(idx, "gt_seq"),
+                            self.store.get(idx, "gt_idxs"), a_mat, sparse=self.sparse_adjacency,
+                            float32=self.float32_tensors)
+
+
+class StreamingGCNDataset(IterableDataset):
+    # GCNDataset samples from a table-format sequence df (df_store.py) without ever loading the frame: the len range
+    # and standard filters run as a PyTables query, and only len, seq and the residue rows are read, chunk_size
+    # records at a time. the selected rows are split into equal contiguous parts per distributed rank (the remainder
+    # is dropped so every rank yields len(self) samples) and those again per DataLoader worker. each iteration visits
+    # its chunks in random order and passes records through a shuffle buffer, seeded by seed, epoch and shard
+
+    def __init__(self, df_path, max_buf_size, n=None, seq_len_range=(128, 512), seed=0, standard_only=True,
+                 chunk_size=1024, shuffle_buffer=4096, cutoff=4, sparse_adjacency=False, float32_tensors=False,
+                 verbose=False):
+        from df_store import DfTable
+        self.table = DfTable(df_path)
+        self.max_buf_size = max_buf_size
+        self.seq_len_range = seq_len_range
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.shuffle_buffer = shuffle_buffer
+        self.cutoff = cutoff
+        self.sparse_adjacency = sparse_adjacency
+        self.float32_tensors = float32_tensors
+        self.verbose = verbose
+        # counts the passes over the data in whichever copy iterates, persistent DataLoader workers included
+        self.epoch = 0
+        rows = self.table.query(seq_len_range, standard_only=standard_only)
+        print("Using {} out of {} sequences".format(df_path, len(rows)))
+        if n is not None and 0 < n < len(rows):
+            rows = np.sort(np.random.RandomState(seed).choice(rows, n, replace=False))
+        self.rows = rows
+        self.n = len(rows)
+
+    def __len__(self):
+        return self.n // world_size()
+
+    def shard_rows(self):
+        per_rank = len(self)
+        rows = self.rows[rank() * per_rank:(rank() + 1) * per_rank]
+        info = get_worker_info()
+        if info is None:
+            return rows, rank()
+        return np.array_split(rows, info.num_workers)[info.id], rank() * info.num_workers + info.id
+
+    def records(self, rows, rn):
+        chunks = [rows[i:i + self.chunk_size] for i in range(0, len(rows), self.chunk_size)]
+        with self.table.open() as store:
+            for k in rn.permutation(len(chunks)):
+                df = self.table.read(store, chunks[k])
+                for i in range(len(df)):
+                    yield tuple(df[c].iloc[i] for c in ("seq", "CA_coors", "mask") if c in df)
+
+    def build(self, record, rn):
+        my_a_mat = None
+        if len(record) > 1:
+            my_a_mat = 1.0 * make_contact_map(record[1] * 0.01, record[2], cutoff=self.cutoff,
+                                              sparse=self.sparse_adjacency, verbose=self.verbose)
+        my_idxs, my_feats, my_seq, my_gt_seq, my_gt_idxs, my_a_mat = assemble_sample(
+            rn, encode_seq(record[0], table=A2ID_TABLE), my_a_mat, self.max_buf_size, self.seq_len_range,
+            verbose=self.verbose)
+        return graph_sample(my_idxs, my_feats, my_gt_seq, my_gt_idxs, my_a_mat, sparse=self.sparse_adjacency,
+                            float32=self.float32_tensors)
+
+    def __iter__(self):
+        rows, shard = self.shard_rows()
+        rn = np.random.RandomState(np.random.SeedSequence((self.seed, self.epoch, shard)).generate_state(1)[0])
+        self.epoch += 1
+        buf = list()
+        for record in self.records(rows, rn):
+            if len(buf) < self.shuffle_buffer:
+                buf.append(record)
+                continue
+            k = rn.randint(len(buf))
+            yield self.build(buf[k], rn)
+            buf[k] = record
+        for k in rn.permutation(len(buf)):
+            yield self.build(buf[k], rn)
@@ -0,0 +1,88 @@
+import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+from candidate_index import graph_csr
+
+
+# one-to-one decoding of a residue-node score matrix (n, m) in place of the per-row argmax of GeneratorLSTM.forward,
+# which lets two residues claim the same node. rows are turned into log-probabilities and the decoded assignment
+# maximizes their sum, exactly with an assignment solver or approximately with a beam search, which can also keep
+# consecutive residues on adjacent nodes (C-alpha continuity). residues beyond the number of nodes fall back to the
+# argmax
+
+
+def assign(logp):
+    n = logp.shape[0]
+    idxs = np.argmax(logp, axis=1)
+    rows, cols = linear_sum_assignment(logp, maximize=True)
+    idxs[rows] = cols
+    return idxs, float(np.sum(logp[np.arange(n), idxs]))
+
+
+def beam_search(logp, adjacency=None, beam_size=8, gap_penalty=2.0, reverse=False):
+    # residues are placed one after the other, from the last one when reverse is set, keeping the beam_size best
+    # partial assignments. with an adjacency (CSR) a residue placed on a node not adjacent to its predecessor's
+    # costs gap_penalty (inf rules it out). steps where every extension is ruled out first drop the continuity and
+    # then the one-to-one constraint
+    n, m = logp.shape
+    total = torch.zeros(1, dtype=logp.dtype)
+    used = torch.zeros(1, m, dtype=torch.bool)
+    last = None
+    parents = list()
+    nodes = list()
+    steps = range(n - 1, -1, -1) if reverse else range(n)
+    for t in steps:
+        row = logp[t].view(1, m)
+        scores = total.view(-1, 1) + row.masked_fill(used, float("-inf"))
+        if adjacency is not None and last is not None:
+            adjacent = torch.from_numpy(adjacency[last.numpy()].toarray())
+            constrained = torch.where(adjacent, scores, scores - gap_penalty)
+            if torch.isfinite(constrained).any():
+                scores = constrained
+        if not torch.isfinite(scores).any():
+            scores = total.view(-1, 1) + row.expand(len(total), m)
+        k = min(beam_size, int(torch.isfinite(scores).sum()))
+        total, flat = torch.topk(scores.view(-1), k)
+        parent = torch.div(flat, m, rounding_mode="floor")
+        last = flat % m
+        used = used[parent]
+        used[torch.arange(k), last] = True
+        parents.append(parent)
+        nodes.append(last)
+    # follow the best beam back to the first step placed
+    idxs = np.empty(n, dtype=np.int64)
+    beam = 0
+    for t, parent, node in zip(reversed(steps), reversed(parents), reversed(nodes)):
+        idxs[t] = int(node[beam])
+        beam = int(parent[beam])
+    return idxs, float(total[0])
+
+
+class Decoder(object):
+    # method "assign" (exact, no continuity) or "beam". the beam search runs in both chain directions over the same
+    # scores and keeps the better result, since it places residues greedily
+
+    def __init__(self, method="assign", beam_size=8, continuity=False, gap_penalty=2.0):
+        if method not in ("assign", "beam"):
+            raise ValueError("unknown decoder {}".format(method))
+        if method == "assign" and continuity:
+            raise ValueError("continuity constraints need the beam decoder")
+        self.method = method
+        self.beam_size = beam_size
+        self.continuity = continuity
+        self.gap_penalty = gap_penalty
+
+    def __call__(self, scores, a_mat=None):
+        # scores (n, m) tensor or array, a_mat the candidate graph (any adjacency format) used for continuity.
+        # returns the node of every residue as an array
+        logp = torch.log_softmax(torch.as_tensor(scores).detach().float().cpu(), dim=1)
+        if self.method == "assign":
+            return assign(logp.numpy())[0]
+        adjacency = graph_csr(a_mat) if self.continuity and a_mat is not None else None
+        best = None
+        for reverse in (False, True):
+            idxs, total = beam_search(logp, adjacency, beam_size=self.beam_size, gap_penalty=self.gap_penalty,
+                                      reverse=reverse)
+            if best is None or total > best[1]:
+                best = idxs, total
+        return best[0]
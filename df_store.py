@@ -0,0 +1,116 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+
+# the sequence database df in PyTables table format, so that records can be filtered by an in-kernel query and
+# read by column and row without loading the whole frame. per-residue arrays (CA_coors, mask) cannot be table
+# columns; they live in a "residues" table with one row per residue, and res_start/res_stop of every record point
+# at its rows there
+
+SCALAR_COLUMNS = ("name", "chain", "len", "seq", "standard")
+DATA_COLUMNS = ("len", "standard")
+
+
+def write_df_table(df, path, chunk_rows=100000, complevel=None):
+    columns = [c for c in SCALAR_COLUMNS if c in df]
+    has_residues = "CA_coors" in df
+    # string columns get a fixed width in the table, which has to fit the longest value of every chunk
+    itemsize = {c: max(1, int(df[c].astype(str).str.len().max())) if len(df) > 0 else 1
+                for c in ("name", "chain", "seq") if c in df}
+    n_res = 0
+    with pd.HDFStore(path, "w", complevel=complevel, complib="blosc" if complevel else None) as store:
+        for i in range(0, len(df), chunk_rows):
+            chunk = df.iloc[i:i + chunk_rows]
+            table = chunk[columns].copy()
+            table.index = np.arange(i, i + len(chunk))
+            if "name" in table:
+                table["name"] = table["name"].astype(str)
+            if has_residues:
+                lens = np.array([len(c) for c in chunk["CA_coors"]], dtype=np.int64)
+                table["res_start"] = n_res + np.cumsum(lens) - lens
+                table["res_stop"] = n_res + np.cumsum(lens)
+                coors = np.concatenate([np.reshape(c, (-1, 3)) for c in chunk["CA_coors"]] + [np.zeros((0, 3))])
+                mask = np.concatenate([np.asarray(m, dtype=bool) for m in chunk["mask"]] + [np.zeros(0, dtype=bool)])
+                residues = pd.DataFrame(dict(x=coors[:, 0], y=coors[:, 1], z=coors[:, 2], mask=mask),
+                                        index=np.arange(n_res, n_res + len(coors)))
+                store.append("residues", residues, index=False)
+                n_res += len(coors)
+            store.append("df", table, data_columns=[c for c in DATA_COLUMNS if c in table], min_itemsize=itemsize,
+                         index=False)
+        store.create_table_index("df", columns=["len"], optlevel=9, kind="full")
+
+
+class DfTable(object):
+    # reader for files written by write_df_table; a handle is opened by whoever iterates, e.g. a DataLoader worker
+
+    def __init__(self, path):
+        self.path = path
+        with pd.HDFStore(path, "r") as store:
+            storer = store.get_storer("df")
+            if not storer.is_table:
+                raise ValueError("{} is not in table format, convert it with df_store.py".format(path))
+            self.n_rows = storer.nrows
+            self.columns = list(store.select("df", start=0, stop=0).columns)
+            self.has_residues = "residues" in store
+
+    def open(self):
+        return pd.HDFStore(self.path, "r")
+
+    def query(self, seq_len_range=None, standard_only=True):
+        # row numbers passing the filters, evaluated by PyTables on the len/standard columns only
+        terms = list()
+        if seq_len_range is not None:
+            terms.extend(["len >= {}".format(seq_len_range[0]), "len <= {}".format(seq_len_range[1])])
+        if standard_only and "standard" in self.columns:
+            terms.append("standard == True")
+        if len(terms) == 0:
+            return np.arange(self.n_rows)
+        with self.open() as store:
+            return np.asarray(store.select_as_coordinates("df", where=" & ".join(terms)), dtype=np.int64)
+
+    def read(self, store, rows, columns=("len", "seq"), residues=True):
+        # records at the sorted row numbers rows with the given columns, plus CA_coors and mask when residues is
+        # set; the residue rows of exactly these records are fetched by coordinate in one read, so records that were
+        # filtered out or not sampled in between are never loaded
+        residues = residues and self.has_residues
+        columns = list(columns) + (["res_start", "res_stop"] if residues else [])
+        if len(rows) == 0:
+            # an empty coordinate selection would select every row
+            return store.select("df", start=0, stop=0, columns=columns)
+        df = store.select("df", where=pd.Index(rows), columns=columns)
+        if residues and len(df) > 0:
+            starts = df["res_start"].to_numpy()
+            lens = df["res_stop"].to_numpy() - starts
+            offsets = np.cumsum(lens) - lens
+            total = int(np.sum(lens))
+            coors = np.zeros((0, 3))
+            mask = np.zeros(0, dtype=bool)
+            if total > 0:
+                res_rows = np.repeat(starts - offsets, lens) + np.arange(total)
+                res = store.select("residues", where=pd.Index(res_rows))
+                coors = res[["x", "y", "z"]].to_numpy()
+                mask = res["mask"].to_numpy()
+            df["CA_coors"] = [coors[i:i + n] for i, n in zip(offsets, lens)]
+            df["mask"] = [mask[i:i + n] for i, n in zip(offsets, lens)]
+        return df
+
+
+def convert_df(src, dst, chunk_rows=100000, complevel=None):
+    df = pd.read_hdf(src, "df")
+    write_df_table(df, dst, chunk_rows=chunk_rows, complevel=complevel)
+    print("converted {} records from {} to {}".format(len(df), src, dst))
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Convert a sequence database df into the streamable table format")
+    p.add_argument("src", type=str, help="h5 file with the df under the key \"df\"")
+    p.add_argument("dst", type=str, help="Output h5 file")
+    p.add_argument("--chunk_rows", type=int, default=100000, help="Records written per append")
+    p.add_argument("--complevel", type=int, default=None, help="blosc compression level")
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    convert_df(args.src, args.dst, chunk_rows=args.chunk_rows, complevel=args.complevel)
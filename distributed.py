@@ -0,0 +1,115 @@
+import os
+import socket
+import torch
+import torch.distributed as dist
+
+
+# data-parallel training over the gloo backend. processes are either launched by torchrun (one or many nodes; RANK,
+# WORLD_SIZE, LOCAL_RANK, LOCAL_WORLD_SIZE, MASTER_ADDR and MASTER_PORT come from the environment) or spawned on
+# this machine by spawn() below, which sets the same variables
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main():
+    return rank() == 0
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def init_distributed(backend="gloo"):
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", os.environ.get("WORLD_SIZE", 1)))
+    if not is_distributed():
+        dist.init_process_group(backend=backend, init_method="env://")
+    return local_rank, local_world_size
+
+
+def pin_threads(local_rank, local_world_size, n_threads=None):
+    # ranks on one node split the CPUs they may run on into disjoint slices and bind to theirs, so that torch's
+    # intra-op pools do not oversubscribe the machine
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count()))
+    per_rank = max(1, len(cpus) // local_world_size)
+    my_cpus = cpus[local_rank * per_rank:(local_rank + 1) * per_rank] or cpus
+    if hasattr(os, "sched_setaffinity") and len(cpus) >= local_world_size:
+        os.sched_setaffinity(0, my_cpus)
+    torch.set_num_threads(n_threads if n_threads is not None else len(my_cpus))
+    return torch.get_num_threads()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def spawn_worker(local_rank, fn, n_procs, port, args):
+    os.environ.update(RANK=str(local_rank), LOCAL_RANK=str(local_rank), WORLD_SIZE=str(n_procs),
+                      LOCAL_WORLD_SIZE=str(n_procs), MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+    fn(args)
+
+
+def spawn(fn, n_procs, args):
+    # runs fn(args) in n_procs processes on this machine, each set up like a torchrun rank
+    torch.multiprocessing.spawn(spawn_worker, args=(fn, n_procs, free_port(), args), nprocs=n_procs, join=True)
+
+
+def all_reduce_mean(value, weight=1.0):
+    # weighted mean of a python number over all ranks
+    if not is_distributed():
+        return value
+    total = torch.tensor([value * weight, weight], dtype=torch.float64)
+    dist.all_reduce(total)
+    return (total[0] / max(total[1], 1e-12)).item()
+
+
+def all_reduce_sum(value):
+    if not is_distributed():
+        return value
+    total = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(total)
+    return type(value)(total[0].item())
+
+
+def merge_logs(log):
+    # every rank logs the same iterations; losses and stage times are averaged over ranks, sample counts and
+    # throughput summed and peak memory is the largest of any rank. validation entries are already global
+    if not is_distributed():
+        return log
+    logs = [None] * world_size()
+    dist.all_gather_object(logs, log)
+    merged = dict(log, train=list())
+    for entries in zip(*[my_log["train"] for my_log in logs]):
+        entry = dict(entries[0])
+        entry["seen"] = sum(e["seen"] for e in entries)
+        entry["loss"] = sum(e["loss"] for e in entries) / len(entries)
+        if "stages" in entry:
+            stages = dict()
+            for k in entry["stages"]:
+                values = [e["stages"][k] for e in entries]
+                if k in ("iters", "samples_per_s", "residues_per_s"):
+                    stages[k] = sum(values)
+                elif k.startswith("peak_"):
+                    stages[k] = max(values)
+                else:
+                    stages[k] = sum(values) / len(values)
+            entry["stages"] = stages
+        merged["train"].append(entry)
+    merged["world_size"] = len(logs)
+    return merged
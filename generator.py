@@ -1,173 +1,201 @@
+"""Train and run the structure generator: build-data, train, infer, eval and serve subcommands."""
 import os
-import time
+import sys
 import json
-import h5py
-import pandas as pd
-import numpy as np
-import torch
-from torch.utils.data import Dataset, DataLoader
-import torch.nn as nn
-import torch.optim as optim
-from aa_code_utils import *
-from dataset import GCNDataset
-from networks import GeneratorLSTM, FocalLoss
 import argparse
 
 
-def train(model, dataset, val_dataset=None, n_epoch=1, lr=0.1, print_every=100, log_every=100, val_every=2000,
-          focalloss=None, device=None, verbose=False):
-    print("====================== train ======================")
-    t0 = time.time()
-    log = dict(train=list(), val=list(), val_seen=list())
-    if focalloss is not None:
-        loss_fn = FocalLoss(weight=None, gamma=focalloss)
-    else:
-        loss_fn = nn.CrossEntropyLoss()
-    optimizer = optim.Adam(model.parameters(), lr=lr)
-    dataloader = DataLoader(dataset, batch_size=1, shuffle=False, num_workers=8, drop_last=False)
-    for i in range(n_epoch):
-        t1 = time.time()
-        for j, data in enumerate(dataloader):
-            model.train()
-            model.zero_grad()
-            x, f, a_mat, d_mat, gt_idxs = data
-            if verbose:
-                print("x", x.size(), "f", f.size(), "a_mat", a_mat.size(), "d_mat", d_mat.size(),
-                      "gt_idxs", gt_idxs.size())
-            n = len(gt_idxs[0, :])
-            if verbose:
-                print(j, list(gt_idxs[0, :]), n)
-            x_tensor = x[0, :].float()
-            f_tensor = f[0, :].float()
-            a_tensor = a_mat[0, :].float()
-            d_tensor = d_mat[0, :].float()
-            g_tensor = gt_idxs[0, :].long()
-            if device is not None:
-                x_tensor = x_tensor.to(device)
-                f_tensor = f_tensor.to(device)
-                a_tensor = a_tensor.to(device)
-                d_tensor = d_tensor.to(device)
-                g_tensor = g_tensor.to(device)
-            scores, _ = model(x_tensor, f_tensor, a_tensor, d_tensor)
-            loss_f = loss_fn(scores, g_tensor.long())
-            loss_r = loss_fn(scores, torch.flip(g_tensor, (0, )).long())
-            loss = torch.min(loss_f, loss_r)
-            loss.backward()
-            optimizer.step()
-            with torch.no_grad():
-                model.seen += 1
-                if (j+1) % log_every == 0:
-                    log["train"].append(dict(epoch=i+1, iter=j+1, seen=model.seen, loss=loss.item()))
-                if (j+1) % print_every == 0:
-                    print("epoch {} loss {:.4f}".format(i, loss.data))
-                if (j+1) % val_every == 0:
-                    if val_dataset is not None:
-                        with torch.no_grad():
-                            val_acc = val(model, val_dataset, device=device, verbose=False)
-                            log["val_seen"].append(dict(seen=model.seen, acc=val_acc))
-                            t2 = time.time()
-                            eta = (t2 - t1) / float(j + 1) * float(len(dataset) - j - 1)
-                            print("seen {}, acc {:.4f}, {:.1f}s to go for this epoch".format(model.seen, val_acc, eta))
-        if val_dataset is not None:
-            with torch.no_grad():
-                val_acc = val(model, val_dataset, device=device, verbose=False)
-                log["val"].append(dict(epoch=i, acc=val_acc))
-                print("seen {}, acc {:.4f}".format(model.seen, val_acc))
-        t2 = time.time()
-        eta = (t2-t0) / float(i+1) * float(n_epoch-i-1)
-        print("time elapsed {:.1f}s, {:.1f}s for this epoch, {:.1f}s to go".format(t2-t0, t2-t1, eta))
-        print("=======================================================================================================")
-    return model, log
-
-
-def val(model, dataset, device=None, verbose=False, reverse_seq=False, output=None):
-    acc_all = 0
-    model.eval()
-    with torch.no_grad():
-        for j in range(len(dataset)):
-            model.zero_grad()
-            x, f, a_mat, d_mat, gt_idxs = dataset[j]
-            n = len(gt_idxs)
-            x_tensor = torch.from_numpy(x).float()
-            f_tensor = torch.from_numpy(f).float()
-            a_tensor = torch.from_numpy(a_mat).float()
-            d_tensor = torch.from_numpy(d_mat).float()
-            g_tensor = torch.from_numpy(gt_idxs).long()
-            if device is not None:
-                x_tensor = x_tensor.to(device)
-                f_tensor = f_tensor.to(device)
-                a_tensor = a_tensor.to(device)
-                d_tensor = d_tensor.to(device)
-                g_tensor = g_tensor.to(device)
-            scores, idxs = model(x_tensor, f_tensor, a_tensor, d_tensor)
-            idxs = np.array(idxs.data.cpu())
-            if reverse_seq:
-                _, rev_idxs = model(torch.flip(x_tensor, [0]), f_tensor, a_tensor, d_tensor)
-                rev_idxs = np.array(torch.flip(rev_idxs, [0]).data.cpu())
-                mask1 = torch.argmax(f_tensor[gt_idxs, :], dim=1) == torch.argmax(f_tensor[rev_idxs, :], dim=1)
-                mask2 = torch.argmax(f_tensor[gt_idxs, :], dim=1) != torch.argmax(f_tensor[idxs, :], dim=1)
-                mask = np.logical_and(mask1.cpu().numpy(), mask2.cpu().numpy())
-                idxs[mask] = rev_idxs[mask]
-            acc_f = np.sum(1 * (idxs == gt_idxs))
-            acc_r = np.sum(1 * (idxs == gt_idxs[::-1]))
-            acc = np.maximum(acc_f, acc_r)
-            acc = acc / float(len(gt_idxs))
-            acc_all = acc_all + acc
-            if verbose:
-                print("GT", "".join([id2a(c) for c in list(torch.argmax(f_tensor[gt_idxs, :], dim=1))]))
-                print("PR", "".join([id2a(c) for c in list(torch.argmax(f_tensor[idxs, :], dim=1))]))
-                print("GT", list(gt_idxs), n)
-                print("PR", list(idxs), n)
-                print(j, acc)
-            if output is not None:
-                scores_np = scores.data.cpu().numpy()
-                np.save(os.path.join(output, "{}.npy".format(str(j).zfill(6))), scores_np)
-    acc_all = acc_all / len(dataset)
-    if verbose:
-        print("overall acc:", acc_all)
-    return acc_all
-            
-
-def parse_args():
-    p = argparse.ArgumentParser(description=__doc__)
-    p.add_argument("--n_train", "-n", type=int, default=10, help="Number of training samples")
-    p.add_argument("--n_val", type=int, default=10, help="Number of val samples")
-    p.add_argument("--n_epoch", "-e", type=int, default=1, help="Number of training epoch")
+# heavy modules (torch, pandas, h5py, scipy) are imported inside the commands that need them, so that e.g.
+# `infer` does not pay for pandas and `--help` for nothing at all
+
+COMMANDS = ("build-data", "train", "infer", "eval", "serve")
+
+
+def add_model_args(p):
+    p.add_argument("--model", "-m", type=str, default=None, help="Path to the pretrained model")
     p.add_argument("--n_graph_layers", type=int, default=1, help="Number of layers in GCN")
-    p.add_argument("--max_n_seq", "-l", type=int, default=10, help="Max sequence length")
-    p.add_argument("--lr", type=float, default=0.01, help="Learning rate")
-    p.add_argument("--focalloss", type=float, default=None, help="Gamma parameter for FocalLoss")
-    p.add_argument("--gpu", "-g", type=int, default=None, help="Use GPU x")
-    p.add_argument("--df", type=str, default=None, help="Path to sequence database df")
-    p.add_argument("--df_val", type=str, default=None, help="Path to sequence database df for validation")
-    p.add_argument("--min_len", type=int, default=4, help="Minium sequence length")
-    p.add_argument("--max_len", type=int, default=8, help="Maximum sequence length")
     p.add_argument("--n_lstm_hidden", type=int, default=256, help="Dimenion of LSTM hidden states")
     p.add_argument("--n_node_embed", type=int, default=128, help="Dimenion of node embeddings")
     p.add_argument("--n_seq_embed", type=int, default=32, help="Dimenion of sequence embeddings")
     p.add_argument("--graph_to_lstm", action="store_true", help="Use graph embedding for LSTM init")
     p.add_argument("--blstm", action="store_true", help="Use bidirectional LSTM")
+    p.add_argument("--score_mem_mb", type=float, default=None,
+                   help="Score residue-node pairs in tiles using at most this many MB of activations")
+    p.add_argument("--gpu", "-g", type=int, default=None, help="Use GPU x")
+    p.add_argument("--threads", type=int, default=None, help="torch intra-op threads, defaults to available CPUs")
     p.add_argument("--seed", type=int, default=2020, help="Random seed for NumPy and Pandas")
-    p.add_argument("--save", "-s", type=str, default=None, help="Path and file name for saving trained model")
-    p.add_argument("--save_val", type=str, default=None, help="Path saving inference results")
-    p.add_argument("--model", "-m", type=str, default=None, help="Path to the pretrained model")
-    p.add_argument("--log", type=str, default=None, help="Path and file name for saving training log")
-    p.add_argument("--skip_training", action="store_true", help="Skip training")
-    p.add_argument("--reverse_seq", action="store_true", help="Reverse sequence when validating")
-    p.add_argument("--h5_tmp", type=str, default=None, help="Save simulated data as h5 file to the given path")
-    p.add_argument("--build_on_the_fly", action="store_true", help="Generate simulated data on the fly")
     p.add_argument("--verbose", "-v", action="store_true", help="Be verbose")
-    return p.parse_args()
 
-    
-def main():
-    args = parse_args()
+
+def add_data_args(p):
+    p.add_argument("--max_n_seq", "-l", type=int, default=10, help="Max sequence length")
+    p.add_argument("--min_len", type=int, default=4, help="Minium sequence length")
+    p.add_argument("--max_len", type=int, default=8, help="Maximum sequence length")
+    p.add_argument("--sparse_adj", action="store_true", help="Feed the GCN a precomputed sparse normalized adjacency")
+    p.add_argument("--graph_cache", type=str, default=None, help="Directory for caching normalized adjacency matrices")
+    p.add_argument("--graph_cache_mb", type=float, default=1024, help="Size cap of the adjacency cache in MB")
+    p.add_argument("--float32", action="store_true",
+                   help="Datasets yield float32 tensors the model uses without per-step conversion")
+
+
+def add_decoder_args(p):
+    p.add_argument("--decoder", type=str, default="argmax", choices=("argmax", "assign", "beam"),
+                   help="Per-residue argmax, or a one-to-one assignment (exact solver or beam search)")
+    p.add_argument("--beam_size", type=int, default=8, help="Beams kept by --decoder beam")
+    p.add_argument("--continuity", action="store_true",
+                   help="Penalize consecutive residues on non-adjacent nodes in --decoder beam")
+    p.add_argument("--gap_penalty", type=float, default=2.0,
+                   help="Log-probability cost of a break for --continuity, inf forbids breaks")
+
+
+def add_val_args(p):
+    p.add_argument("--n_val", type=int, default=10, help="Number of val samples")
+    p.add_argument("--df_val", type=str, default=None, help="Path to sequence database df for validation")
+    p.add_argument("--reverse_seq", action="store_true", help="Reverse sequence when validating")
+    p.add_argument("--save_val", type=str, default=None, help="Path saving inference results")
+    p.add_argument("--val_batch_size", type=int, default=None,
+                   help="Run the final validation through the batched inference engine with this batch size")
+    p.add_argument("--val_workers", type=int, default=4, help="DataLoader workers for --val_batch_size")
+    add_decoder_args(p)
+
+
+def parse_args(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # without a subcommand the script trains, as it always has
+    if len(argv) == 0 or (argv[0] not in COMMANDS and argv[0] not in ("-h", "--help")):
+        argv = ["train"] + argv
+    p = argparse.ArgumentParser(description=__doc__)
+    sub = p.add_subparsers(dest="command")
+
+    b = sub.add_parser("build-data", help="Simulate or extract samples into a ragged h5 file")
+    b.add_argument("output", type=str, help="Output .h5 file")
+    b.add_argument("--n", "-n", type=int, default=10, help="Number of samples")
+    b.add_argument("--df", type=str, default=None, help="Path to sequence database df")
+    b.add_argument("--max_n_seq", "-l", type=int, default=10, help="Max sequence length")
+    b.add_argument("--min_len", type=int, default=4, help="Minium sequence length")
+    b.add_argument("--max_len", type=int, default=8, help="Maximum sequence length")
+    b.add_argument("--seed", type=int, default=2020, help="Random seed for NumPy and Pandas")
+    b.add_argument("--h5_compression", type=str, default=None, help="Compression filter for the h5 file")
+    b.add_argument("--build_batch_size", type=int, default=None,
+                   help="Synthesize simulated samples this many at a time with vectorized NumPy ops")
+    b.add_argument("--build_workers", type=int, default=None,
+                   help="Build with this many processes using per-sample seeds")
+    b.add_argument("--shard_size", type=int, default=10000, help="Samples per shard for --build_workers")
+
+    t = sub.add_parser("train", help="Train a model, then validate it")
+    add_model_args(t)
+    add_data_args(t)
+    add_val_args(t)
+    t.add_argument("--skip_training", action="store_true", help="Skip training and only validate, like eval")
+    t.add_argument("--n_train", "-n", type=int, default=10, help="Number of training samples")
+    t.add_argument("--n_epoch", "-e", type=int, default=1, help="Number of training epoch")
+    t.add_argument("--batch_size", "-b", type=int, default=1, help="Number of samples per optimizer step")
+    t.add_argument("--lr", type=float, default=0.01, help="Learning rate")
+    t.add_argument("--focalloss", type=float, default=None, help="Gamma parameter for FocalLoss")
+    t.add_argument("--df", type=str, default=None, help="Path to sequence database df")
+    t.add_argument("--data", type=str, default=None, help="Train on a file written by build-data instead")
+    t.add_argument("--stream", action="store_true",
+                   help="Stream --df in chunks instead of loading it; it must be in df_store.py table format")
+    t.add_argument("--chunk_size", type=int, default=1024, help="Records per read for --stream")
+    t.add_argument("--shuffle_buffer", type=int, default=4096, help="Shuffle buffer size for --stream")
+    t.add_argument("--save", "-s", type=str, default=None, help="Path and file name for saving trained model")
+    t.add_argument("--log", type=str, default=None, help="Path and file name for saving training log")
+    t.add_argument("--h5_tmp", type=str, default=None, help="Save simulated data as h5 file to the given path")
+    t.add_argument("--h5_format", type=str, default="datasets", choices=["datasets", "ragged"],
+                   help="Store --h5_tmp data as per-sample datasets or as one ragged SampleStore file")
+    t.add_argument("--h5_compression", type=str, default=None, help="Compression filter for the ragged h5 format")
+    t.add_argument("--mmap", action="store_true", help="Memory-map uncompressed ragged h5 data")
+    t.add_argument("--build_workers", type=int, default=None,
+                   help="Pre-build the training set with this many processes using per-sample seeds")
+    t.add_argument("--shard_size", type=int, default=10000, help="Samples per shard for --build_workers")
+    t.add_argument("--build_on_the_fly", action="store_true", help="Generate simulated data on the fly")
+    t.add_argument("--build_batch_size", type=int, default=None,
+                   help="Synthesize simulated samples this many at a time with vectorized NumPy ops")
+    t.add_argument("--sampled_loss", action="store_true",
+                   help="Train on a sampled softmax over true, neighbouring and random candidate nodes")
+    t.add_argument("--n_hard_neg", type=int, default=16, help="Graph-neighbour negatives per residue")
+    t.add_argument("--n_random_neg", type=int, default=32, help="Random negatives per residue")
+    t.add_argument("--exact_epochs", type=int, default=0, help="Finish with this many epochs of the exact loss")
+    t.add_argument("--async_val", action="store_true",
+                   help="Validate model snapshots in a background process instead of pausing training")
+    t.add_argument("--val_threads", type=int, default=1, help="CPUs reserved for --async_val")
+    t.add_argument("--workers", type=int, default=8, help="DataLoader workers per training process")
+    t.add_argument("--nproc", type=int, default=None,
+                   help="Train data-parallel in this many processes on this machine; under torchrun, use its ranks")
+    t.add_argument("--instrument", action="store_true",
+                   help="Log per-stage timings, throughput and peak memory of the train loop")
+    t.add_argument("--profile_iters", type=int, nargs=2, default=None,
+                   help="Record a torch.profiler trace from iteration START to STOP")
+    t.add_argument("--profile_trace", type=str, default="trace.json", help="Output file for --profile_iters")
+
+    i = sub.add_parser("infer", help="Score a file written by build-data with a trained model")
+    i.add_argument("data", type=str, help="Input file written by build-data")
+    add_model_args(i)
+    i.add_argument("--output", "-o", type=str, default=None, help="Directory for scores.h5")
+    i.add_argument("--batch_size", "-b", type=int, default=16, help="Samples per forward pass")
+    i.add_argument("--workers", type=int, default=0, help="DataLoader workers")
+    i.add_argument("--sparse_adj", action="store_true", help="Feed the GCN a precomputed sparse normalized adjacency")
+    i.add_argument("--mmap", action="store_true", help="Memory-map the uncompressed input file")
+    i.add_argument("--float32", action="store_true",
+                   help="Datasets yield float32 tensors the model uses without per-step conversion")
+    i.add_argument("--reverse_seq", action="store_true", help="Also score the reversed sequences")
+    add_decoder_args(i)
+    i.add_argument("--quantize", action="store_true",
+                   help="Run a dynamic int8 quantized copy of the model on CPU (needs torchao)")
+
+    e = sub.add_parser("eval", help="Validate a trained model")
+    add_model_args(e)
+    add_data_args(e)
+    add_val_args(e)
+    e.add_argument("--data", type=str, default=None, help="Validate on a file written by build-data instead")
+    e.add_argument("--quantize", action="store_true",
+                   help="Validate a dynamic int8 quantized copy of the model on CPU next to fp32 (needs torchao)")
+    e.add_argument("--topk", type=int, default=None,
+                   help="Compare approximate scoring against the K nearest nodes of the neighbours' assignments with "
+                        "the exact model")
+    e.add_argument("--topk_seed_every", type=int, default=8, help="Residues between exactly scored seeds for --topk")
+    e.add_argument("--topk_iters", type=int, default=16, help="Refinement passes for --topk")
+
+    s = sub.add_parser("serve", help="Keep a trained model loaded and score requests over HTTP")
+    add_model_args(s)
+    s.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    s.add_argument("--port", type=int, default=8080, help="TCP port to listen on")
+    s.add_argument("--socket", type=str, default=None, help="Listen on this unix socket instead of TCP")
+    s.add_argument("--batch_size", "-b", type=int, default=16, help="Max requests per forward pass")
+    s.add_argument("--max_wait_ms", type=float, default=10,
+                   help="How long the first queued request waits for others to join its batch")
+    s.add_argument("--cutoff", type=float, default=4, help="C-alpha contact distance for the candidate graph")
+    s.add_argument("--topk", type=int, default=None,
+                   help="Score each request approximately against the K nodes nearest to the neighbours' assignments")
+    s.add_argument("--topk_seed_every", type=int, default=8, help="Residues between exactly scored seeds for --topk")
+    s.add_argument("--topk_iters", type=int, default=16, help="Refinement passes for --topk")
+    s.add_argument("--quantize", action="store_true",
+                   help="Serve a dynamic int8 quantized copy of the model on CPU (needs torchao)")
+    return p.parse_args(argv)
+
+
+def build_data(args):
+    from dataset import GCNDataset
+    if not args.output.endswith(".h5"):
+        raise ValueError("output must be an .h5 file, got {}".format(args.output))
+    GCNDataset(n=args.n, max_buf_size=args.max_n_seq, df_path=args.df, h5=args.output,
+               seq_len_range=(args.min_len, args.max_len), seed=args.seed, build_batch_size=args.build_batch_size,
+               h5_format="ragged", h5_compression=args.h5_compression, n_build_workers=args.build_workers,
+               shard_size=args.shard_size, verbose=False)
+    print("samples written to {}".format(args.output))
+
+
+def make_model(args):
+    import torch
+    from networks import GeneratorLSTM
+    from trainer import set_cpu_threads
     torch.manual_seed(args.seed)
-    val_dataset = GCNDataset(n=args.n_val, max_buf_size=args.max_n_seq, df_path=args.df_val,
-                             seq_len_range=(args.min_len, args.max_len), seed=args.seed+1, verbose=False)
+    if args.threads is not None or getattr(args, "quantize", False):
+        print("using {} intra-op threads".format(set_cpu_threads(args.threads)))
     model = GeneratorLSTM(n_graph_layers=args.n_graph_layers, device=args.gpu, n_lstm_hidden=args.n_lstm_hidden,
                           n_node_embed=args.n_node_embed, n_seq_embed=args.n_seq_embed,
-                          graph_to_lstm=args.graph_to_lstm, bidirectional_lstm=args.blstm)
+                          graph_to_lstm=args.graph_to_lstm, bidirectional_lstm=args.blstm,
+                          score_mem_budget=None if args.score_mem_mb is None else int(args.score_mem_mb * 2 ** 20))
     model.seen = 0
     if args.model is not None:
         model.load_state_dict(torch.load(args.model, map_location="cpu"))
@@ -179,22 +207,165 @@ def main():
     model = model.to(device)
     if args.verbose:
         print(model)
+    return model, device
+
+
+def make_graph_cache(args):
+    if args.graph_cache is None:
+        return None
+    from graph_cache import GraphCache
+    return GraphCache(args.graph_cache, max_bytes=int(args.graph_cache_mb * 2 ** 20))
+
+
+def make_val_dataset(args, graph_cache=None):
+    from dataset import GCNDataset, PreparedDataset
+    if args.command == "eval" and args.data is not None:
+        return PreparedDataset(args.data, sparse_adjacency=args.sparse_adj, float32_tensors=args.float32)
+    return GCNDataset(n=args.n_val, max_buf_size=args.max_n_seq, df_path=args.df_val,
+                      seq_len_range=(args.min_len, args.max_len), seed=args.seed+1,
+                      sparse_adjacency=args.sparse_adj, graph_cache=graph_cache, float32_tensors=args.float32,
+                      verbose=False)
+
+
+def make_decoder(args):
+    if args.decoder == "argmax":
+        return None
+    from decoder import Decoder
+    return Decoder(args.decoder, beam_size=args.beam_size, continuity=args.continuity, gap_penalty=args.gap_penalty)
+
+
+def validate(model, val_dataset, device, args):
+    from trainer import evaluate, compare_quantized, compare_topk
+    if getattr(args, "topk", None) is not None:
+        compare_topk(model, val_dataset, k=args.topk, seed_every=args.topk_seed_every, n_iter=args.topk_iters,
+                     device=device, output=args.save_val)
+        return
+    if getattr(args, "quantize", False):
+        _, results = compare_quantized(model, val_dataset, batch_size=args.val_batch_size,
+                                       num_workers=args.val_workers, reverse_seq=args.reverse_seq,
+                                       output=args.save_val, decoder=make_decoder(args))
+        speedup = results["fp32"]["time"] / max(results["int8"]["time"], 1e-9)
+        print("int8 vs fp32: acc {:+.5f}, speedup x{:.2f}".format(results["int8"]["acc"] - results["fp32"]["acc"],
+                                                                  speedup))
+        return
+    val_acc = evaluate(model, val_dataset, device=device, batch_size=args.val_batch_size, num_workers=args.val_workers,
+                       verbose=True, reverse_seq=args.reverse_seq, output=args.save_val, decoder=make_decoder(args))
+    print("test on validation set: {:.5f}".format(val_acc))
+
+
+def train_model(args):
     if args.skip_training:
-        pass
+        eval_model(args)
+        return
+    # torchrun sets WORLD_SIZE for every rank it starts; otherwise --nproc spawns the ranks here
+    if args.nproc is not None and args.nproc > 1 and "WORLD_SIZE" not in os.environ:
+        from distributed import spawn
+        spawn(train_rank, args.nproc, args)
+    else:
+        train_rank(args)
+
+
+def train_rank(args):
+    import torch
+    from dataset import GCNDataset, PreparedDataset, StreamingGCNDataset
+    from distributed import init_distributed, pin_threads, is_main, cleanup
+    from trainer import train
+    distributed = int(os.environ.get("WORLD_SIZE", 1)) > 1
+    if distributed:
+        if args.h5_tmp is not None:
+            raise ValueError("ranks cannot share --h5_tmp; write the data once with build-data and pass --data")
+        local_rank, local_world_size = init_distributed()
+        n_threads = pin_threads(local_rank, local_world_size, args.threads)
+        print("rank {} of {} using {} threads".format(os.environ["RANK"], os.environ["WORLD_SIZE"], n_threads))
+        if args.gpu is not None:
+            args.gpu = args.gpu + local_rank
+    model, device = make_model(args)
+    graph_cache = make_graph_cache(args)
+    val_dataset = make_val_dataset(args, graph_cache) if args.n_val > 0 else None
+    if args.data is not None:
+        train_dataset = PreparedDataset(args.data, sparse_adjacency=args.sparse_adj, mmap=args.mmap,
+                                        float32_tensors=args.float32)
+    elif args.stream:
+        train_dataset = StreamingGCNDataset(args.df, args.max_n_seq, n=args.n_train,
+                                            seq_len_range=(args.min_len, args.max_len), seed=args.seed,
+                                            chunk_size=args.chunk_size, shuffle_buffer=args.shuffle_buffer,
+                                            sparse_adjacency=args.sparse_adj, float32_tensors=args.float32)
     else:
         train_dataset = GCNDataset(n=args.n_train, max_buf_size=args.max_n_seq, df_path=args.df, h5=args.h5_tmp,
                                    seq_len_range=(args.min_len, args.max_len), build_on_the_fly=args.build_on_the_fly,
-                                   seed=args.seed, verbose=False)
-        model, json_log = train(model, train_dataset, val_dataset=val_dataset, n_epoch=args.n_epoch, lr=args.lr,
-                                device=device, focalloss=args.focalloss, verbose=args.verbose)
-        if args.save:
-            torch.save(model.state_dict(), args.save)
-        if args.log:
-            json_log["params"] = args.__dict__
-            with open(args.log, "w") as f:
-                f.write(json.dumps(json_log))
-    val_acc = val(model, val_dataset, device=device, verbose=True, reverse_seq=args.reverse_seq, output=args.save_val)
-    print("test on validation set: {:.5f}".format(val_acc))
+                                   seed=args.seed, sparse_adjacency=args.sparse_adj,
+                                   build_batch_size=args.build_batch_size, h5_format=args.h5_format,
+                                   h5_compression=args.h5_compression, mmap=args.mmap, graph_cache=graph_cache,
+                                   n_build_workers=args.build_workers, shard_size=args.shard_size,
+                                   float32_tensors=args.float32, verbose=False)
+    model, json_log = train(model, train_dataset, val_dataset=val_dataset, n_epoch=args.n_epoch, lr=args.lr,
+                            batch_size=args.batch_size, device=device, focalloss=args.focalloss,
+                            instrument=args.instrument, profile_iters=args.profile_iters,
+                            profile_trace=args.profile_trace, num_workers=args.workers,
+                            sampled_loss=args.sampled_loss, n_hard=args.n_hard_neg, n_random=args.n_random_neg,
+                            exact_epochs=args.exact_epochs, async_val=args.async_val, val_threads=args.val_threads,
+                            verbose=args.verbose)
+    main_rank = is_main()
+    if distributed:
+        cleanup()
+    if not main_rank:
+        return
+    if args.save:
+        torch.save(model.state_dict(), args.save)
+    if args.log:
+        json_log["params"] = args.__dict__
+        with open(args.log, "w") as f:
+            f.write(json.dumps(json_log))
+    if val_dataset is not None:
+        validate(model, val_dataset, device, args)
+
+
+def infer_data(args):
+    import torch
+    from dataset import PreparedDataset
+    from networks import quantize_model
+    from trainer import infer
+    model, device = make_model(args)
+    if args.quantize:
+        model = quantize_model(model)
+        device = torch.device("cpu")
+    dataset = PreparedDataset(args.data, sparse_adjacency=args.sparse_adj, mmap=args.mmap,
+                              float32_tensors=args.float32)
+    acc = infer(model, dataset, batch_size=args.batch_size, num_workers=args.workers, device=device,
+                reverse_seq=args.reverse_seq, output=args.output, decoder=make_decoder(args))
+    print("acc {:.5f} on {} samples".format(acc, len(dataset)))
+
+
+def eval_model(args):
+    model, device = make_model(args)
+    validate(model, make_val_dataset(args, make_graph_cache(args)), device, args)
+
+
+def serve_model(args):
+    import torch
+    from networks import quantize_model
+    from server import serve
+    model, device = make_model(args)
+    if args.quantize:
+        model = quantize_model(model)
+        device = torch.device("cpu")
+    serve(model, device=device, host=args.host, port=args.port, socket_path=args.socket, max_batch_size=args.batch_size,
+          max_wait_ms=args.max_wait_ms, cutoff=args.cutoff, topk=args.topk, seed_every=args.topk_seed_every,
+          n_iter=args.topk_iters, verbose=args.verbose)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "build-data":
+        build_data(args)
+    elif args.command == "train":
+        train_model(args)
+    elif args.command == "infer":
+        infer_data(args)
+    elif args.command == "eval":
+        eval_model(args)
+    elif args.command == "serve":
+        serve_model(args)
 
 
 if __name__ == "__main__":
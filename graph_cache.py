@@ -0,0 +1,88 @@
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from scipy.sparse import coo_matrix, load_npz, save_npz
+
+
+class GraphCache(object):
+    # normalized adjacency matrices as float32 COO .npz files named by the hash of their key, with a per-process
+    # in-memory LRU in front. files are touched on every hit and the least recently used ones are removed once the
+    # directory grows beyond max_bytes
+
+    def __init__(self, cache_dir, max_bytes=2**30, memory_items=1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self.memory = OrderedDict()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.n_bytes = sum(os.path.getsize(p) for p in self.files())
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts):
+        h = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                h.update(np.ascontiguousarray(part).tobytes())
+            else:
+                h.update(repr(part).encode())
+            h.update(b"|")
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, "{}.npz".format(key))
+
+    def files(self):
+        return [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith(".npz")]
+
+    def remember(self, key, mat):
+        self.memory[key] = mat
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+        try:
+            mat = load_npz(self.path(key))
+            os.utime(self.path(key))
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.remember(key, mat)
+        return mat
+
+    def put(self, key, mat):
+        mat = coo_matrix(mat, dtype=np.float32)
+        self.remember(key, mat)
+        tmp = "{}.{}.tmp".format(self.path(key), os.getpid())
+        with open(tmp, "wb") as handle:
+            save_npz(handle, mat, compressed=False)
+        os.replace(tmp, self.path(key))
+        self.n_bytes += os.path.getsize(self.path(key))
+        if self.n_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        files = list()
+        for p in self.files():
+            try:
+                files.append((os.path.getmtime(p), os.path.getsize(p), p))
+            except OSError:
+                continue
+        files.sort()
+        self.n_bytes = sum(f[1] for f in files)
+        for _, size, p in files:
+            if self.n_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+            self.n_bytes -= size
@@ -1,35 +1,226 @@
+import os
+import re
+import gzip
+import argparse
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
+from aa_code_utils import AA1, aa3_to_aa1_array
 
 
-def parse_pdb(text):
-    data = list()
+ATOM_COLUMNS = ["record", "atom_no", "atom_name", "alt", "res_name", "chain", "res_no",
+                "insertion", "x", "y", "z", "occupancy", "factor"]
+
+# fixed-width ATOM record fields: name, first and last byte, type
+PDB_FIELDS = [("record", 0, 4, str), ("atom_no", 6, 11, int), ("atom_name", 12, 16, str), ("alt", 16, 17, str),
+              ("res_name", 17, 20, str), ("chain", 21, 22, str), ("res_no", 22, 26, int), ("insertion", 26, 27, str),
+              ("x", 30, 38, float), ("y", 38, 46, float), ("z", 46, 54, float), ("occupancy", 54, 60, float),
+              ("factor", 60, 66, float)]
+
+# mmCIF _atom_site items filling the same columns, the first one present is used; the auth_* items are optional
+CIF_FIELDS = [("record", ("group_PDB", ), str), ("atom_no", ("id", ), int),
+              ("atom_name", ("auth_atom_id", "label_atom_id"), str), ("alt", ("label_alt_id", ), str),
+              ("res_name", ("auth_comp_id", "label_comp_id"), str), ("chain", ("auth_asym_id", "label_asym_id"), str),
+              ("res_no", ("auth_seq_id", "label_seq_id"), int), ("insertion", ("pdbx_PDB_ins_code", ), str),
+              ("x", ("Cartn_x", ), float), ("y", ("Cartn_y", ), float), ("z", ("Cartn_z", ), float),
+              ("occupancy", ("occupancy", ), float), ("factor", ("B_iso_or_equiv", ), float)]
+
+# a CIF token is quoted with ' or " (closed by the same quote followed by whitespace, so it may hold spaces and the
+# other quote) or runs to the next whitespace, keeping primes as in C5'
+CIF_TOKEN = re.compile(rb"'(.*?)'(?=\s|$)|\"(.*?)\"(?=\s|$)|(\S+)")
+
+
+def parse_pdb(text, ca_only=False):
+    # text is an iterable of lines (str or bytes), e.g. an open PDB file
+    lines = list()
     for line in text:
-#         print(line[0:4])
-        if line[0:4] == "ATOM":
-            record = line[0:4]
-            atom_no = int(line[6:11])
-            atom_name = line[12:16]
-            alt = line[16]
-            res_name = line[17:20]
-            chain = line[21]
-            res_no = int(line[22:26])
-            insertion = line[26]
-            x = float(line[30:38])
-            y = float(line[38:46])
-            z = float(line[46:54])
-            occupancy = float(line[54:60])
-            factor = float(line[60:66])
-            data.append([record, atom_no, atom_name, alt, res_name, chain, res_no, insertion, x, y, z, occupancy, factor])
-        else:
-            continue
-        
-    df = pd.DataFrame(data, columns=["record", "atom_no", "atom_name", "alt", "res_name", "chain", "res_no",
-                                     "insertion", "x", "y", "z", "occupancy", "factor"])
-    return df
+        if isinstance(line, str):
+            line = line.encode()
+        if line[0:4] == b"ATOM":
+            lines.append(line)
+    return parse_pdb_records(lines, ca_only=ca_only)
 
 
 def extract_seq(df):
     df = df[["chain", "res_name", "res_no"]].drop_duplicates().reset_index(drop=True)
     return df
-        
+
+
+def open_structure(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def decode_column(col, dtype):
+    if dtype is str:
+        return col.astype(str)
+    blank = np.char.strip(col) == b""
+    if np.any(blank):
+        col = np.where(blank, b"nan" if dtype is float else b"0", col)
+    return col.astype(np.float64 if dtype is float else np.int64)
+
+
+def parse_pdb_records(lines, ca_only=False):
+    # lines are raw ATOM records as bytes; they are laid out as one (n, 80) byte array and every field is decoded
+    # for all atoms at once from a fixed-width view of its columns
+    buf = np.frombuffer(b"".join(line.rstrip(b"\r\n").ljust(80)[:80] for line in lines), dtype="S1").reshape(-1, 80)
+    if ca_only:
+        buf = buf[np.ascontiguousarray(buf[:, 12:16]).view("S4").ravel() == b" CA "]
+    data = dict()
+    for name, start, stop, dtype in PDB_FIELDS:
+        col = np.ascontiguousarray(buf[:, start:stop]).view("S{}".format(stop - start)).ravel()
+        data[name] = decode_column(col, dtype)
+    return pd.DataFrame(data, columns=ATOM_COLUMNS)
+
+
+def parse_pdb_file(path, ca_only=False, chunk_lines=100000):
+    # streams the file, plain or gzipped, and decodes ATOM records in chunks of chunk_lines
+    chunks = list()
+    lines = list()
+    with open_structure(path) as handle:
+        for line in handle:
+            if line.startswith(b"ATOM"):
+                lines.append(line)
+                if len(lines) == chunk_lines:
+                    chunks.append(parse_pdb_records(lines, ca_only=ca_only))
+                    lines = list()
+            elif line.startswith(b"ENDMDL"):
+                break
+    if len(lines) > 0 or len(chunks) == 0:
+        chunks.append(parse_pdb_records(lines, ca_only=ca_only))
+    return pd.concat(chunks, ignore_index=True)
+
+
+def cif_tokens(line):
+    if b"'" not in line and b'"' not in line:
+        return line.split()
+    return [q1 or q2 or t for q1, q2, t in CIF_TOKEN.findall(line.strip())]
+
+
+def cif_item(items, names):
+    # column of the first of names present in items, None if there is none
+    for name in names:
+        if name in items:
+            return items.index(name)
+    return None
+
+
+def parse_cif_records(rows, items, ca_only=False):
+    rows = np.array(rows, dtype="S").reshape(-1, len(items))
+    if ca_only:
+        rows = rows[rows[:, cif_item(items, ("auth_atom_id", "label_atom_id"))] == b"CA"]
+    data = dict()
+    for name, names, dtype in CIF_FIELDS:
+        k = cif_item(items, names)
+        if k is not None:
+            col = rows[:, k]
+        else:
+            col = np.full(len(rows), b"?")
+        if dtype is str:
+            col = np.where(np.logical_or(col == b".", col == b"?"), b" ", col)
+        elif k is None:
+            col = np.full(len(rows), b"")
+        data[name] = decode_column(col, dtype)
+    return pd.DataFrame(data, columns=ATOM_COLUMNS)
+
+
+def parse_cif_file(path, ca_only=False, chunk_lines=100000):
+    # streams the _atom_site loop of an mmCIF file, plain or gzipped, into the same columns as parse_pdb_file
+    chunks = list()
+    rows = list()
+    items = list()
+    model = None
+    with open_structure(path) as handle:
+        for line in handle:
+            if line.startswith(b"_atom_site."):
+                items.append(line.strip()[len(b"_atom_site."):].decode())
+            elif line.startswith(b"ATOM"):
+                tokens = cif_tokens(line)
+                if "pdbx_PDB_model_num" in items:
+                    if model is None:
+                        model = tokens[items.index("pdbx_PDB_model_num")]
+                    elif tokens[items.index("pdbx_PDB_model_num")] != model:
+                        break
+                rows.append(tokens)
+                if len(rows) == chunk_lines:
+                    chunks.append(parse_cif_records(rows, items, ca_only=ca_only))
+                    rows = list()
+            elif len(rows) > 0 and not line.startswith(b"HETATM"):
+                break
+    if len(rows) > 0 or len(chunks) == 0:
+        chunks.append(parse_cif_records(rows, items, ca_only=ca_only) if len(items) > 0 else
+                      pd.DataFrame(columns=ATOM_COLUMNS))
+    return pd.concat(chunks, ignore_index=True)
+
+
+def parse_structure_file(path, ca_only=False):
+    name = path[:-3] if path.endswith(".gz") else path
+    if name.endswith(".cif"):
+        return parse_cif_file(path, ca_only=ca_only)
+    return parse_pdb_file(path, ca_only=ca_only)
+
+
+def structure_records(df, name=None, coor_scale=100.0):
+    # one row per chain in the len/seq/CA_coors/mask layout GCNDataset reads; residues without a CA atom are
+    # masked and get NaN coordinates. CA_coors are scaled by coor_scale (GCNDataset multiplies them by 0.01)
+    records = list()
+    if len(df) == 0:
+        return records
+    key = df["chain"].to_numpy() + ":" + df["res_no"].to_numpy().astype(str) + ":" + df["insertion"].to_numpy()
+    new_res = np.concatenate(([True], key[1:] != key[:-1]))
+    res_ids = np.cumsum(new_res) - 1
+    res_first = np.flatnonzero(new_res)
+    ca = np.flatnonzero(np.char.strip(df["atom_name"].to_numpy().astype(str)) == "CA")
+    ca_res, ca_first = np.unique(res_ids[ca], return_index=True)
+    coors = np.full((len(res_first), 3), np.nan)
+    coors[ca_res] = df[["x", "y", "z"]].to_numpy()[ca[ca_first]] * coor_scale
+    mask = np.zeros(len(res_first), dtype=bool)
+    mask[ca_res] = True
+    chains = df["chain"].to_numpy()[res_first]
+    res_aa1 = aa3_to_aa1_array(df["res_name"].to_numpy()[res_first].astype(str), unknown="X")
+    for chain in pd.unique(chains):
+        sel = chains == chain
+        seq = "".join(res_aa1[sel])
+        records.append(dict(name=name, chain=chain, len=len(seq), seq=seq, CA_coors=coors[sel], mask=mask[sel],
+                            standard=all(c in AA1 for c in set(seq))))
+    return records
+
+
+def parse_structure_records(path):
+    name = os.path.basename(path).split(".")[0]
+    return structure_records(parse_structure_file(path, ca_only=False), name=name)
+
+
+def parse_structures(paths, n_workers=1, chunksize=4):
+    # parses many PDB/mmCIF files in parallel into one df with the schema GCNDataset expects
+    records = list()
+    if n_workers > 1:
+        with Pool(n_workers) as pool:
+            for i, my_records in enumerate(pool.imap(parse_structure_records, paths, chunksize=chunksize)):
+                records.extend(my_records)
+                if (i+1) % 1000 == 0:
+                    print("parsed {} files".format(i+1))
+    else:
+        for path in paths:
+            records.extend(parse_structure_records(path))
+    return pd.DataFrame(records, columns=["name", "chain", "len", "seq", "CA_coors", "mask", "standard"])
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Parse PDB/mmCIF files into a sequence database df")
+    p.add_argument("output", type=str, help="Output h5 file, the df is stored under the key \"df\"")
+    p.add_argument("paths", type=str, nargs="+", help="PDB or mmCIF files, optionally gzipped")
+    p.add_argument("--workers", "-j", type=int, default=1, help="Number of parsing processes")
+    p.add_argument("--table", action="store_true", help="Write the streamable table format of df_store.py")
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    df = parse_structures(args.paths, n_workers=args.workers)
+    if args.table:
+        from df_store import write_df_table
+        write_df_table(df, args.output)
+    else:
+        df.to_hdf(args.output, key="df")
@@ -1,5 +1,8 @@
+import copy
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.utils.checkpoint import checkpoint
 
 
 class GCN(nn.Module):
@@ -24,23 +27,28 @@ class GCN(nn.Module):
         self.relu = nn.ReLU()
 
     def forward(self, mat_a, mat_d, mat_f):
-        mat_d = torch.mm(torch.mm(mat_d, mat_a), mat_d)
+        if mat_d is None:
+            # mat_a is already the normalized adjacency D^-1/2 A D^-1/2, dense or torch.sparse
+            mat_d = mat_a
+        else:
+            mat_d = torch.mm(torch.mm(mat_d, mat_a), mat_d)
+        mm = torch.sparse.mm if mat_d.is_sparse else torch.mm
         x = mat_f
         if self.n_layers > 1:
-            x = torch.mm(mat_d, x)
+            x = mm(mat_d, x)
             x = self.relu(self.W1(x))
         if self.n_layers > 2:
-            x = torch.mm(mat_d, x)
+            x = mm(mat_d, x)
             x = self.relu(self.W2(x))
         if self.n_layers > 3:
-            x = torch.mm(mat_d, x)
+            x = mm(mat_d, x)
             x = self.relu(self.W3(x))
         if self.n_layers > 4:
-            x = torch.mm(mat_d, x)
+            x = mm(mat_d, x)
             x = self.relu(self.W4(x))
         # output layer
         if self.n_layers > 0:
-            x = torch.mm(mat_d, x)
+            x = mm(mat_d, x)
             x = self.W_out(x)
         return x
 
@@ -50,7 +58,7 @@ class GeneratorLSTM(nn.Module):
 
     def __init__(self, n_feat=20, n_node_embed=64, n_lstm_hidden=128, n_graph_embed=None, n_seq_embed=32,
                  n_seq_alphabets=20, n_graph_layers=1, n_lstm_layers=1, bidirectional_lstm=False, graph_to_lstm=False,
-                 device="cpu"):
+                 score_mem_budget=None, device="cpu"):
         super(GeneratorLSTM, self).__init__()
         self.graph_to_lstm = graph_to_lstm
         self.n_lstm_hidden = n_lstm_hidden
@@ -71,6 +79,8 @@ class GeneratorLSTM(nn.Module):
             self.nodes2gating = nn.Linear(n_node_embed, self.n_graph_embed)
             self.nodes2graph = nn.Linear(n_node_embed, self.n_graph_embed)
         self.seq2embed = nn.Linear(n_seq_alphabets, n_seq_embed)
+        # peak bytes allowed for the n x m x H edge activations; None scores all pairs in one go
+        self.score_mem_budget = score_mem_budget
         self.device = device
 
     def get_graph(self, h_nodes):
@@ -78,9 +88,40 @@ class GeneratorLSTM(nn.Module):
         h_graph = torch.sum(nn.Sigmoid()(self.nodes2gating(h_nodes)) * h_graph, dim=0)
         return h_graph
 
-    def forward(self, x_tensor, f_tensor, a_tensor, d_tensor):
+    def score_tile(self, lstm_out, h_edges):
+        return self.graph2addedge(nn.ReLU()(lstm_out.unsqueeze(-2) + h_edges.unsqueeze(-3))).squeeze(-1)
+
+    def score_edges(self, lstm_out, h_edges):
+        # lstm_out is (..., n, H) and h_edges (..., m, H); leading dims are batch dims
+        n, h = lstm_out.size()[-2:]
+        m = h_edges.size(-2)
+        if self.score_mem_budget is None:
+            return self.score_tile(lstm_out, h_edges)
+        # the sum and its ReLU are both alive inside a tile
+        row_bytes = 2 * h * lstm_out[..., 0, 0].numel() * lstm_out.element_size()
+        tile_m = int(min(m, max(1, self.score_mem_budget // row_bytes)))
+        tile_n = int(min(n, max(1, self.score_mem_budget // (row_bytes * tile_m))))
+        # recompute tiles in backward instead of keeping every tile's activations for autograd
+        recompute = torch.is_grad_enabled() and (lstm_out.requires_grad or h_edges.requires_grad)
+        scores = list()
+        for i in range(0, n, tile_n):
+            row = list()
+            for j in range(0, m, tile_m):
+                if recompute:
+                    row.append(checkpoint(self.score_tile, lstm_out[..., i:i + tile_n, :],
+                                          h_edges[..., j:j + tile_m, :], use_reentrant=False))
+                else:
+                    row.append(self.score_tile(lstm_out[..., i:i + tile_n, :], h_edges[..., j:j + tile_m, :]))
+            scores.append(torch.cat(row, dim=-1))
+        return torch.cat(scores, dim=-2)
+
+    def score_candidates(self, lstm_out, h_edges, cand):
+        # lstm_out (R, H) for R residues, h_edges (M, H) and cand (R, K) node indices: only R x K pairs are scored
+        return self.graph2addedge(nn.ReLU()(lstm_out.unsqueeze(-2) + h_edges[cand])).squeeze(-1)
+
+    def encode(self, x_tensor, f_tensor, a_tensor, d_tensor=None):
+        # LSTM states of the n residues (n, H) and edge embeddings of the m nodes (m, H)
         n = int(x_tensor.size(0))
-        m = int(f_tensor.size(0))
         seq_embed = self.seq2embed(x_tensor)
         f_nodes_in = self.feat2embed(f_tensor)
         h_nodes_in = self.gcn(a_tensor, d_tensor, nn.ReLU()(f_nodes_in))
@@ -92,12 +133,187 @@ class GeneratorLSTM(nn.Module):
             h = torch.zeros(self.n_lstm_layers * self.n_lstm_directions, 1, self.n_lstm_hidden).to(self.device)
             c = torch.zeros(self.n_lstm_layers * self.n_lstm_directions, 1, self.n_lstm_hidden).to(self.device)
         lstm_out, _ = self.lstm(seq_embed.view(-1, 1, self.n_seq_embed), (h, c))
-        scores = self.node2addedge(h_nodes_in).view(1, m, -1).repeat(n, 1, 1)
-        scores += lstm_out.view(n, 1, -1).repeat(1, m, 1)
-        scores = self.graph2addedge(nn.ReLU()(scores.view(n*m, -1))).view(n, m)
+        return lstm_out.view(n, -1), self.node2addedge(h_nodes_in)
+
+    def forward(self, x_tensor, f_tensor, a_tensor, d_tensor=None):
+        scores = self.score_edges(*self.encode(x_tensor, f_tensor, a_tensor, d_tensor))
         idxs = torch.argmax(scores, dim=1)
         return scores, idxs
 
+    def forward_sampled(self, x_tensor, f_tensor, a_tensor, d_tensor, cand):
+        # scores (n, K) of every residue against its candidate nodes cand (n, K) only
+        lstm_out, h_edges = self.encode(x_tensor, f_tensor, a_tensor, d_tensor)
+        return self.score_candidates(lstm_out, h_edges, cand)
+
+    def forward_topk(self, x_tensor, f_tensor, a_tensor, d_tensor, nbrs, seed_every=8, n_iter=16):
+        # approximate forward for inference. nbrs (m, k) holds the k nearest nodes of every node, itself first and
+        # -1 padded (see candidate_index.py). every seed_every-th residue is scored against all nodes; after that
+        # residue i is only scored against the neighbours of the nodes currently assigned to residues i - 1, i
+        # and i + 1, so assignments spread out from the seeds and then move to better nodes nearby. each pass
+        # rescores only the residues whose candidates changed, until none did. a residue's own node is always a
+        # candidate, so its best score never drops. returns the scores as a sparse (n, m) tensor of the pairs
+        # each residue was scored on last, the assignment and the number of pairs scored in total
+        lstm_out, h_edges = self.encode(x_tensor, f_tensor, a_tensor, d_tensor)
+        n, m = lstm_out.size(0), h_edges.size(0)
+        k = 3 * nbrs.size(1)
+        seeds = torch.arange(0, n, seed_every, device=lstm_out.device)
+        idxs = torch.full((n,), -1, dtype=torch.long, device=lstm_out.device)
+        idxs[seeds] = torch.argmax(self.score_edges(lstm_out[seeds], h_edges), dim=1)
+        n_scored = len(seeds) * m
+        cand_all = torch.full((n, k), -1, dtype=torch.long, device=lstm_out.device)
+        scores_all = torch.full((n, k), float("-inf"), device=lstm_out.device)
+        none = idxs.new_full((1,), -1)
+        unchanged = torch.zeros(1, dtype=torch.bool, device=lstm_out.device)
+        active = torch.arange(n, device=lstm_out.device)
+        for _ in range(max(1, n_iter)):
+            anchor = torch.stack((idxs, torch.cat((none, idxs[:-1])), torch.cat((idxs[1:], none))), 1)[active]
+            cand = torch.where(anchor.unsqueeze(2) >= 0, nbrs[anchor.clamp(min=0)], -1).view(len(active), k)
+            # sorted, so repeats of a node are adjacent and only the first of them counts
+            cand = torch.sort(cand, dim=1)[0]
+            valid = (cand >= 0) & torch.cat((torch.ones_like(cand[:, :1], dtype=torch.bool),
+                                             cand[:, 1:] != cand[:, :-1]), 1)
+            scores = self.score_candidates(lstm_out[active], h_edges, cand.clamp(min=0))
+            scores = scores.masked_fill(~valid, float("-inf"))
+            n_scored += int(valid.sum())
+            cand_all[active] = torch.where(valid, cand, -1)
+            scores_all[active] = scores
+            new = idxs.clone()
+            new[active] = torch.where(valid.any(dim=1),
+                                      cand.gather(1, torch.argmax(scores, dim=1, keepdim=True)).squeeze(1), -1)
+            changed = new != idxs
+            if not changed.any():
+                break
+            idxs = new
+            # a residue's candidates change with its own assignment and those of its sequence neighbours
+            active = torch.nonzero(changed | torch.cat((changed[1:], unchanged)) |
+                                   torch.cat((unchanged, changed[:-1]))).view(-1)
+        valid = cand_all >= 0
+        res = torch.arange(n, device=lstm_out.device).view(-1, 1).expand_as(cand_all)
+        pairs = [torch.stack((res[valid], cand_all[valid]))]
+        values = [scores_all[valid]]
+        # residues the assignments did not reach within n_iter passes are scored exactly
+        rows = torch.nonzero(idxs < 0).view(-1)
+        if len(rows) > 0:
+            row_scores = self.score_edges(lstm_out[rows], h_edges)
+            idxs[rows] = torch.argmax(row_scores, dim=1)
+            n_scored += len(rows) * m
+            cols = torch.arange(m, device=rows.device).repeat(len(rows))
+            pairs.append(torch.stack((rows.repeat_interleave(m), cols)))
+            values.append(row_scores.reshape(-1))
+        sparse = torch.sparse_coo_tensor(torch.cat(pairs, 1), torch.cat(values), (n, m), check_invariants=False)
+        return sparse.coalesce(), idxs, n_scored
+
+    def encode_batch(self, x_tensor, x_lens, f_tensor, f_lens, a_tensor):
+        # x_tensor is (n_max, B, n_alphabets) padded, f_tensor the (sum of m, n_feat) node features of all
+        # samples and a_tensor their block-diagonal normalized adjacency, as produced by collate_graphs. returns
+        # padded LSTM states (n_max, B, H) and the edge embeddings of all nodes (sum of m, H)
+        b = len(x_lens)
+        graph_ids = torch.repeat_interleave(torch.arange(b), f_lens).to(f_tensor.device)
+        seq_embed = self.seq2embed(x_tensor)
+        f_nodes_in = self.feat2embed(f_tensor)
+        h_nodes_in = self.gcn(a_tensor, None, nn.ReLU()(f_nodes_in))
+        if self.graph_to_lstm:
+            h_graph = nn.Sigmoid()(self.nodes2gating(h_nodes_in)) * self.nodes2graph(h_nodes_in)
+            h_graph = torch.zeros(b, h_graph.size(1), device=h_graph.device).index_add(0, graph_ids, h_graph)
+            h_graph = h_graph.view(b, 2, -1, self.n_lstm_hidden)
+            h = h_graph[:, 0].transpose(0, 1).contiguous()
+            c = h_graph[:, 1].transpose(0, 1).contiguous()
+        else:
+            h = torch.zeros(self.n_lstm_layers * self.n_lstm_directions, b, self.n_lstm_hidden).to(self.device)
+            c = torch.zeros(self.n_lstm_layers * self.n_lstm_directions, b, self.n_lstm_hidden).to(self.device)
+        packed = pack_padded_sequence(seq_embed, x_lens.cpu(), enforce_sorted=False)
+        lstm_out, _ = self.lstm(packed, (h, c))
+        lstm_out, _ = pad_packed_sequence(lstm_out)
+        return lstm_out, self.node2addedge(h_nodes_in)
+
+    def forward_batch(self, x_tensor, x_lens, f_tensor, f_lens, a_tensor):
+        b = len(x_lens)
+        m_max = int(torch.max(f_lens))
+        graph_ids = torch.repeat_interleave(torch.arange(b), f_lens).to(f_tensor.device)
+        node_pos = torch.arange(len(graph_ids), device=f_tensor.device) - \
+            torch.repeat_interleave(torch.cumsum(f_lens, 0) - f_lens, f_lens).to(f_tensor.device)
+        lstm_out, h_edges = self.encode_batch(x_tensor, x_lens, f_tensor, f_lens, a_tensor)
+        h_edges = torch.zeros(b, m_max, h_edges.size(1), device=h_edges.device).index_put((graph_ids, node_pos),
+                                                                                           h_edges)
+        scores = self.score_edges(lstm_out.transpose(0, 1), h_edges)
+        node_mask = torch.arange(m_max, device=scores.device).view(1, 1, -1) >= f_lens.to(scores.device).view(-1, 1, 1)
+        scores = scores.masked_fill(node_mask, float("-inf"))
+        idxs = torch.argmax(scores, dim=2)
+        return scores, idxs
+
+    def forward_batch_sampled(self, x_tensor, x_lens, f_tensor, f_lens, a_tensor, res_b, res_i, cand):
+        # scores (R, K) of the R residues at sequence positions res_i of samples res_b against their candidate
+        # nodes cand (R, K), indexed into the stacked nodes of the batch
+        lstm_out, h_edges = self.encode_batch(x_tensor, x_lens, f_tensor, f_lens, a_tensor)
+        return self.score_candidates(lstm_out[res_i, res_b], h_edges, cand)
+
+
+class GeneratorMethods(nn.Module):
+    # forward calls the GeneratorLSTM method named by its first argument, so that wrappers which hook into forward
+    # (e.g. DistributedDataParallel, which syncs gradients) see every kind of call
+
+    def __init__(self, model):
+        super(GeneratorMethods, self).__init__()
+        self.model = model
+
+    def forward(self, method, *args):
+        return getattr(self.model, method)(*args)
+
+
+def sample_candidates(gt_f, gt_r, node_lo, node_n, a_tensor, n_hard=16, n_random=32):
+    # candidate nodes (R, K) of R residues for sampled-softmax training: the true node in forward order (column 0)
+    # and in reversed order (column 1), n_hard hard negatives drawn from the graph neighbours of those two nodes
+    # (spatial contacts or chain neighbours), and n_random nodes drawn uniformly from the residue's own graph,
+    # whose nodes are node_lo .. node_lo + node_n - 1. repeated candidates are flagged in dup so they count once
+    # in the softmax, and target_r gives the column of the reversed-order target
+    if a_tensor.is_sparse:
+        rows, cols = a_tensor.coalesce().indices()
+    else:
+        rows, cols = a_tensor.nonzero().t()
+    r = len(gt_f)
+    deg = torch.bincount(rows, minlength=a_tensor.size(0))
+    ptr = torch.cumsum(deg, 0) - deg
+    anchor = torch.where(torch.arange(n_hard, device=gt_f.device) % 2 == 0, gt_f.view(-1, 1), gt_r.view(-1, 1))
+    anchor_deg = deg[anchor]
+    pick = ptr[anchor] + (torch.rand(r, n_hard, device=gt_f.device) * anchor_deg).long()
+    rand = node_lo.view(-1, 1) + (torch.rand(r, n_hard + n_random, device=gt_f.device) * node_n.view(-1, 1)).long()
+    # nodes without neighbours get random candidates instead
+    hard = torch.where(anchor_deg > 0, cols[torch.clamp(pick, max=max(len(cols) - 1, 0))], rand[:, :n_hard])
+    cand = torch.cat((gt_f.view(-1, 1), gt_r.view(-1, 1), hard, rand[:, n_hard:]), 1)
+    k = cand.size(1)
+    earlier = torch.triu(torch.ones(k, k, dtype=torch.bool, device=cand.device), diagonal=1)
+    dup = torch.any((cand.unsqueeze(2) == cand.unsqueeze(1)) & earlier, dim=1)
+    target_r = (cand[:, 1] != cand[:, 0]).long()
+    return cand, dup, target_r
+
+
+def sampled_softmax_loss(scores, dup, target_r, sample_ids, n_samples, gamma=None):
+    # both directions from one log-softmax over the candidates: per sample the mean cross entropy (or focal loss
+    # with gamma) of the forward and of the reversed targets, the smaller of the two, averaged over samples.
+    # negatives are not importance-corrected, so this is a training surrogate for the exact loss
+    scores = scores.masked_fill(dup, float("-inf"))
+    lse = torch.logsumexp(scores, dim=1)
+    ce = torch.stack((lse - scores[:, 0], lse - torch.gather(scores, 1, target_r.view(-1, 1)).squeeze(1)), 1)
+    if gamma is not None:
+        ce = (1 - torch.exp(-ce)) ** gamma * ce
+    totals = torch.zeros(n_samples, 2, device=ce.device).index_add(0, sample_ids, ce)
+    counts = torch.bincount(sample_ids, minlength=n_samples).clamp(min=1).view(-1, 1)
+    return torch.mean(torch.min(totals / counts, dim=1)[0])
+
+
+def quantize_model(model):
+    # CPU-only copy with int8 weights in every nn.Linear (embeddings, GCN layers, edge scorer) and activations
+    # quantized to int8 on the fly per call, with torchao, which replaces the deprecated torch.ao.quantization. the
+    # LSTM, a small share of the cost next to scoring every residue-node pair, stays float
+    from torchao.quantization import Int8DynamicActivationInt8WeightConfig, quantize_
+    model = copy.deepcopy(model).cpu().eval()
+    model.device = "cpu"
+    quantize_(model, Int8DynamicActivationInt8WeightConfig())
+    # uncompiled, torchao's int8 matmuls are slower than fp32 on CPU; the pair scorer that dominates is compiled once
+    # for dynamic shapes
+    model.score_tile = torch.compile(model.score_tile, dynamic=True)
+    return model
+
 
 class FocalLoss(nn.Module):
 
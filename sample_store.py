@@ -0,0 +1,195 @@
+import os
+import argparse
+import numpy as np
+import h5py
+
+
+SAMPLE_FIELDS = ("idxs", "f", "seq", "gt_seq", "gt_idxs")
+
+
+class SampleStoreWriter(object):
+    # every field is one array ragged along axis 0 plus an "{field}_offsets" index with n+1 entries.
+    # samples are spilled to flat temporary files while writing and copied into the h5 file on close, so the
+    # final datasets get their exact size: contiguous (memory-mappable) without compression, chunked with it
+
+    def __init__(self, filename, fields=SAMPLE_FIELDS, compression=None, chunk_rows=65536):
+        self.filename = filename
+        self.fields = fields
+        self.compression = compression
+        self.chunk_rows = chunk_rows
+        self.spill = dict()
+        self.dtypes = dict()
+        self.shapes = dict()
+        self.offsets = {k: [0] for k in fields}
+
+    def append(self, sample):
+        for k, v in zip(self.fields, sample):
+            v = np.ascontiguousarray(v)
+            if k not in self.spill:
+                self.spill[k] = open("{}.{}.tmp".format(self.filename, k), "wb")
+                self.dtypes[k] = v.dtype
+                self.shapes[k] = v.shape[1:]
+            self.spill[k].write(v.astype(self.dtypes[k], copy=False).tobytes())
+            self.offsets[k].append(self.offsets[k][-1] + len(v))
+
+    def __len__(self):
+        return len(self.offsets[self.fields[0]]) - 1
+
+    def close(self):
+        with h5py.File(self.filename, "w") as handle:
+            handle.attrs["n"] = len(self)
+            for k in self.fields:
+                handle.create_dataset("{}_offsets".format(k), data=np.array(self.offsets[k], dtype=np.int64))
+                if k not in self.spill:
+                    continue
+                self.spill[k].close()
+                spill_name = "{}.{}.tmp".format(self.filename, k)
+                shape = (self.offsets[k][-1], ) + self.shapes[k]
+                if self.compression is None:
+                    ds = handle.create_dataset(k, shape, dtype=self.dtypes[k])
+                else:
+                    chunks = (max(1, min(self.chunk_rows, shape[0])), ) + self.shapes[k]
+                    ds = handle.create_dataset(k, shape, dtype=self.dtypes[k], chunks=chunks,
+                                               compression=self.compression)
+                if shape[0] > 0:
+                    src = np.memmap(spill_name, dtype=self.dtypes[k], mode="r", shape=shape)
+                    for i in range(0, shape[0], self.chunk_rows):
+                        ds[i:i + self.chunk_rows] = src[i:i + self.chunk_rows]
+                    del src
+                os.remove(spill_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SampleStore(object):
+    # the h5 handle is opened on first access in each process, never inherited by forked DataLoader workers
+
+    def __init__(self, filename, fields=SAMPLE_FIELDS, mmap=False):
+        self.filename = filename
+        self.fields = fields
+        self.mmap = mmap
+        self.handle = None
+        self.pid = None
+        self.arrays = None
+        with h5py.File(self.filename, "r") as handle:
+            self.n = int(handle.attrs["n"])
+            self.offsets = {k: handle["{}_offsets".format(k)][()] for k in self.fields}
+
+    def open(self):
+        if self.pid == os.getpid():
+            return
+        self.handle = h5py.File(self.filename, "r")
+        self.pid = os.getpid()
+        self.arrays = dict()
+        for k in self.fields:
+            if k not in self.handle:
+                continue
+            ds = self.handle[k]
+            offset = ds.id.get_offset()
+            if self.mmap and ds.compression is None and ds.chunks is None and offset is not None:
+                self.arrays[k] = np.memmap(self.filename, dtype=ds.dtype, mode="r", offset=offset, shape=ds.shape)
+            else:
+                self.arrays[k] = ds
+
+    def __len__(self):
+        return self.n
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+        self.handle = None
+        self.pid = None
+        self.arrays = None
+
+    def get(self, idx, field):
+        self.open()
+        return self.arrays[field][self.offsets[field][idx]:self.offsets[field][idx + 1]]
+
+    def __getitem__(self, idx):
+        return tuple(self.get(idx, k) for k in self.fields)
+
+
+class ScoreStore(object):
+    # appendable store for per-sample score matrices of varying shape: values are flattened into one resizable
+    # float32 dataset with "offsets", "shapes" and the sample "ids" alongside
+
+    def __init__(self, filename, mode="a", chunk_size=2**20, compression=None):
+        self.filename = filename
+        self.handle = h5py.File(filename, mode)
+        if "scores" not in self.handle:
+            self.handle.create_dataset("scores", (0, ), maxshape=(None, ), dtype=np.float32, chunks=(chunk_size, ),
+                                       compression=compression)
+            self.handle.create_dataset("offsets", data=np.zeros(1, dtype=np.int64), maxshape=(None, ))
+            self.handle.create_dataset("shapes", (0, 2), maxshape=(None, 2), dtype=np.int64)
+            self.handle.create_dataset("ids", (0, ), maxshape=(None, ), dtype=np.int64)
+        self.index = {sample_id: k for k, sample_id in enumerate(self.handle["ids"][()])}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, sample_id):
+        return sample_id in self.index
+
+    def extend(self, sample_ids, scores):
+        scores = [np.asarray(v, dtype=np.float32) for v in scores]
+        k = len(self.handle["ids"])
+        start = int(self.handle["offsets"][-1])
+        sizes = np.array([v.size for v in scores], dtype=np.int64)
+        for name, n in (("scores", start + int(np.sum(sizes))), ("offsets", k + len(scores) + 1),
+                        ("shapes", k + len(scores)), ("ids", k + len(scores))):
+            self.handle[name].resize(n, axis=0)
+        if np.sum(sizes) > 0:
+            self.handle["scores"][start:] = np.concatenate([v.ravel() for v in scores])
+        self.handle["offsets"][k + 1:] = start + np.cumsum(sizes)
+        self.handle["shapes"][k:] = np.array([v.shape for v in scores], dtype=np.int64).reshape(-1, 2)
+        self.handle["ids"][k:] = np.asarray(sample_ids, dtype=np.int64)
+        for j, sample_id in enumerate(sample_ids):
+            self.index[int(sample_id)] = k + j
+
+    def append(self, sample_id, scores):
+        self.extend([sample_id], [scores])
+
+    def __getitem__(self, sample_id):
+        k = self.index[sample_id]
+        offsets = self.handle["offsets"]
+        return self.handle["scores"][offsets[k]:offsets[k + 1]].reshape(self.handle["shapes"][k])
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def convert_h5(src, dst, compression=None):
+    # per-sample "idxs_{i}", "f_{i}", ... layout written by GCNDataset.build_all into one SampleStore file
+    # df-backed files also hold the contact maps as "a_rows_{i}", "a_cols_{i}"
+    with h5py.File(src, "r") as handle:
+        n = len([k for k in handle.keys() if k.startswith("idxs_")])
+        fields = SAMPLE_FIELDS + ("a_rows", "a_cols") if "a_rows_0" in handle else SAMPLE_FIELDS
+        with SampleStoreWriter(dst, fields=fields, compression=compression) as writer:
+            for i in range(n):
+                writer.append([handle["{}_{}".format(k, i)][()] for k in fields])
+                if (i+1) % 10000 == 0:
+                    print("converted {} samples".format(i+1))
+    print("converted {} samples from {} to {}".format(n, src, dst))
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Convert a per-sample GCNDataset h5 file into a SampleStore file")
+    p.add_argument("src", type=str, help="h5 file written by GCNDataset.build_all")
+    p.add_argument("dst", type=str, help="Output SampleStore file")
+    p.add_argument("--compression", type=str, default=None, help="h5py compression filter, e.g. gzip or lzf")
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    convert_h5(args.src, args.dst, compression=args.compression)
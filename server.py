@@ -0,0 +1,328 @@
+import os
+import json
+import queue
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+from aa_code_utils import A2ID_TABLE, encode_seq
+from candidate_index import knn_coors
+from dataset import collate_graphs, make_contact_map, make_norm_a_matrix, onehot, sparse_to_tensor
+from trainer import to_tensor
+
+
+# persistent inference server for `generator.py serve`: the model is loaded once, and requests arriving
+# concurrently over HTTP (TCP or a unix socket) are scored together in forward_batch calls. a request is turned into
+# a graph sample on its own handler thread; the first request in the queue waits at most max_wait_ms for others to
+# join its batch. with topk set, requests are scored one at a time by forward_topk instead, against the nodes
+# nearest (by their coordinates) to the current assignments. endpoints: POST /score, GET /metrics, GET /health
+
+
+def make_sample(request, cutoff=4):
+    # model inputs for one request: seq is the one-letter sequence, features the (m, 20) residue type
+    # probabilities of the m candidates and coors their (m, 3) C-alpha coordinates, NaN for unknown
+    seq = encode_seq(request["seq"], table=A2ID_TABLE)
+    f = np.asarray(request["features"], dtype=np.float32)
+    coors = np.asarray(request["coors"], dtype=np.float64)
+    if len(seq) == 0:
+        raise ValueError("empty sequence")
+    if f.ndim != 2 or f.shape[1] != 20:
+        raise ValueError("features must be (m, 20), got {}".format(f.shape))
+    if coors.shape != (len(f), 3):
+        raise ValueError("coors must be ({}, 3) to match features, got {}".format(len(f), coors.shape))
+    # candidates without coordinates keep a self loop so that normalizing their row stays finite
+    a_mat = make_contact_map(coors, mask=np.all(np.isfinite(coors), axis=1), cutoff=cutoff, sparse=True)
+    return onehot(seq), f, sparse_to_tensor(make_norm_a_matrix(a_mat)), None, np.zeros(len(seq), dtype=np.int64)
+
+
+def percentiles(values, qs=(50, 95, 99)):
+    if len(values) == 0:
+        return dict(("p{}".format(q), None) for q in qs)
+    return dict(("p{}".format(q), float(v)) for q, v in zip(qs, np.percentile(list(values), qs)))
+
+
+class ServerMetrics(object):
+    # counters since start and latencies in ms over the last `window` requests and batches
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched = 0
+        self.max_queue_depth = 0
+        self.latency = deque(maxlen=window)
+        self.queue_wait = deque(maxlen=window)
+        self.batch_time = deque(maxlen=window)
+
+    def record_queue_depth(self, depth):
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def record_batch(self, size, waits, batch_time):
+        with self.lock:
+            self.batches += 1
+            self.batched += size
+            self.queue_wait.extend(1000 * w for w in waits)
+            self.batch_time.append(1000 * batch_time)
+
+    def record_request(self, latency, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            if not error:
+                self.latency.append(1000 * latency)
+
+    def snapshot(self, queue_depth):
+        with self.lock:
+            return dict(uptime_s=time.time() - self.started, requests=self.requests, errors=self.errors,
+                        batches=self.batches, mean_batch_size=self.batched / float(max(self.batches, 1)),
+                        queue_depth=queue_depth, max_queue_depth=self.max_queue_depth,
+                        latency_ms=percentiles(self.latency), queue_wait_ms=percentiles(self.queue_wait),
+                        batch_ms=percentiles(self.batch_time))
+
+
+class Batcher(object):
+    # a single thread owns the model and runs queued samples in batches of up to max_batch_size
+
+    def __init__(self, model, device=None, max_batch_size=16, max_wait_ms=10, topk=None, seed_every=8, n_iter=16,
+                 metrics=None):
+        self.model = model.eval()
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.topk = topk
+        self.seed_every = seed_every
+        self.n_iter = n_iter
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, sample, nbrs=None):
+        # nbrs, the (m, topk) nearest candidates of every candidate, is needed with topk
+        future = Future()
+        self.queue.put((time.time(), sample, nbrs, future))
+        self.metrics.record_queue_depth(self.queue.qsize())
+        return future
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = item[0] + self.max_wait
+            stop = False
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self.run_batch(batch)
+            if stop:
+                return
+
+    def run_batch(self, batch):
+        t0 = time.time()
+        try:
+            with torch.no_grad():
+                if self.topk is not None:
+                    results = [self.score_topk(sample, nbrs) for _, sample, nbrs, _ in batch]
+                else:
+                    results = self.score_batch([sample for _, sample, _, _ in batch])
+            for (_, _, _, future), result in zip(batch, results):
+                future.set_result(result)
+        except Exception as e:
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        self.metrics.record_batch(len(batch), [t0 - t for t, _, _, _ in batch], time.time() - t0)
+
+    def score_batch(self, samples):
+        x, x_lens, f, f_lens, a_mat, _, _ = collate_graphs(samples)
+        scores, idxs = self.model.forward_batch(to_tensor(x, device=self.device), x_lens,
+                                                to_tensor(f, device=self.device), f_lens,
+                                                to_tensor(a_mat, device=self.device))
+        scores = scores.cpu().numpy()
+        idxs = idxs.cpu().numpy()
+        return [(scores[k, :int(x_lens[k]), :int(f_lens[k])], idxs[k, :int(x_lens[k])]) for k in range(len(samples))]
+
+    def score_topk(self, sample, nbrs):
+        # pairs forward_topk never scored are -inf
+        x, f, a_mat, _, _ = sample
+        f_tensor = to_tensor(f, device=self.device)
+        scores, idxs, _ = self.model.forward_topk(to_tensor(x, device=self.device), f_tensor,
+                                                  to_tensor(a_mat, device=self.device), None,
+                                                  torch.from_numpy(nbrs).to(f_tensor.device), self.seed_every,
+                                                  self.n_iter)
+        dense = torch.full(scores.size(), float("-inf"))
+        dense[tuple(scores.indices().cpu())] = scores.values().cpu()
+        return dense.numpy(), idxs.cpu().numpy()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.reply(200, self.server.metrics.snapshot(self.server.batcher.queue.qsize()))
+        elif self.path == "/health":
+            self.reply(200, dict(status="ok"))
+        else:
+            self.reply(404, dict(error="unknown path {}".format(self.path)))
+
+    def do_POST(self):
+        if self.path != "/score":
+            self.reply(404, dict(error="unknown path {}".format(self.path)))
+            return
+        t0 = time.time()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            sample = make_sample(request, cutoff=self.server.cutoff)
+            topk = self.server.batcher.topk
+            nbrs = None if topk is None else knn_coors(request["coors"], topk)
+        except (ValueError, KeyError, TypeError) as e:
+            self.server.metrics.record_request(time.time() - t0, error=True)
+            self.reply(400, dict(error="bad request: {}".format(e)))
+            return
+        try:
+            scores, idxs = self.server.batcher.submit(sample, nbrs).result()
+        except Exception as e:
+            self.server.metrics.record_request(time.time() - t0, error=True)
+            self.reply(500, dict(error=str(e)))
+            return
+        out = dict(idxs=idxs.tolist(), score=scores[np.arange(len(idxs)), idxs].tolist())
+        if request.get("return_scores", False):
+            out["scores"] = scores.tolist()
+        self.server.metrics.record_request(time.time() - t0)
+        self.reply(200, out)
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class InferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # pipelines open many connections at once; the socketserver default backlog of 5 resets them
+    request_queue_size = 128
+
+    def __init__(self, address, batcher, cutoff=4, verbose=False):
+        self.batcher = batcher
+        self.metrics = batcher.metrics
+        self.cutoff = cutoff
+        self.verbose = verbose
+        ThreadingHTTPServer.__init__(self, address, Handler)
+
+
+class UnixInferenceServer(InferenceServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        # HTTPServer.server_bind would look up a host name for the address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def server_close(self):
+        InferenceServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def warm_up(batcher, n=8, m=16):
+    # dummy requests before serving, so that the first real ones do not pay for lazy initialization; two at once,
+    # so that a compiled (quantized) model also sees a batch of more than one sample
+    rn = np.random.RandomState(0)
+    coors = np.cumsum(rn.randn(m, 3), axis=0) * 3.8
+    request = dict(seq="A" * n, features=onehot(rn.randint(0, 20, m)), coors=coors)
+    nbrs = None if batcher.topk is None else knn_coors(coors, batcher.topk)
+    futures = [batcher.submit(make_sample(request), nbrs) for _ in range(2)]
+    for future in futures:
+        future.result()
+
+
+def serve(model, device=None, host="127.0.0.1", port=8080, socket_path=None, max_batch_size=16, max_wait_ms=10,
+          cutoff=4, topk=None, seed_every=8, n_iter=16, verbose=False):
+    batcher = Batcher(model, device=device, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, topk=topk,
+                      seed_every=seed_every, n_iter=n_iter)
+    warm_up(batcher)
+    if socket_path is not None:
+        server = UnixInferenceServer(socket_path, batcher, cutoff=cutoff, verbose=verbose)
+        print("serving on unix socket {}".format(socket_path))
+    else:
+        server = InferenceServer((host, port), batcher, cutoff=cutoff, verbose=verbose)
+        print("serving on http://{}:{}".format(host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+class UnixHTTPConnection(HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def connect(address, timeout=None):
+    # address is host:port or the path of a unix socket
+    if os.path.sep in address or ":" not in address:
+        return UnixHTTPConnection(address, timeout=timeout)
+    host, port = address.rsplit(":", 1)
+    return HTTPConnection(host, int(port), timeout=timeout)
+
+
+def score(address, seq, features, coors, return_scores=False, timeout=None):
+    # client for a running server; returns the decoded response, raising on errors
+    body = json.dumps(dict(seq=seq, features=np.asarray(features).tolist(), coors=np.asarray(coors).tolist(),
+                           return_scores=return_scores))
+    conn = connect(address, timeout=timeout)
+    try:
+        conn.request("POST", "/score", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        out = json.loads(response.read())
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError("server returned {}: {}".format(response.status, out.get("error")))
+    return out
@@ -0,0 +1,112 @@
+import sys
+import time
+import resource
+from collections import OrderedDict
+import torch
+
+
+def reset_peak_rss():
+    # Linux lets a process reset its own VmHWM; elsewhere the peak includes everything that ran before
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        pass
+
+
+def rss_mb():
+    # current resident set size, 0 where /proc is not available
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return 0.0
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    scale = 1.0 if sys.platform == "darwin" else 1024.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale / 1024.0
+
+
+class StageTimer(object):
+    # accumulates wall time per named stage between consecutive lap() calls; a disabled timer does nothing.
+    # on CUDA devices every lap synchronizes so that asynchronous kernels are charged to the stage that launched them
+
+    def __init__(self, enabled=True, device=None):
+        self.enabled = enabled
+        self.cuda = device is not None and torch.device(device).type == "cuda"
+        self.totals = OrderedDict()
+        self.n_iters = 0
+        self.n_samples = 0
+        self.n_residues = 0
+        self.t = None
+        self.t_window = None
+        self.t_pause = None
+
+    def start(self):
+        if self.enabled:
+            if self.cuda:
+                torch.cuda.synchronize()
+            self.t = time.perf_counter()
+            if self.t_window is None:
+                self.t_window = self.t
+                self.reset_peaks()
+            elif self.t_pause is not None:
+                self.t_window += self.t - self.t_pause
+            self.t_pause = None
+
+    def pause(self):
+        # the time until the next start() (e.g. validation) is left out of the window's throughput
+        if self.enabled and self.t_pause is None:
+            self.t_pause = time.perf_counter()
+
+    def reset_peaks(self):
+        reset_peak_rss()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def lap(self, stage):
+        if not self.enabled:
+            return
+        if self.cuda:
+            torch.cuda.synchronize()
+        t = time.perf_counter()
+        self.totals[stage] = self.totals.get(stage, 0.0) + t - self.t
+        self.t = t
+
+    def count(self, n_samples, n_residues):
+        self.n_iters += 1
+        self.n_samples += n_samples
+        self.n_residues += n_residues
+
+    def flush(self):
+        # per-iteration stage means, throughput and peak memory since the previous flush
+        if not self.enabled:
+            return None
+        t = time.perf_counter() if self.t_pause is None else self.t_pause
+        elapsed = max(t - self.t_window, 1e-9)
+        stats = OrderedDict(("{}_s".format(k), v / max(self.n_iters, 1)) for k, v in self.totals.items())
+        stats["iters"] = self.n_iters
+        stats["samples_per_s"] = self.n_samples / elapsed
+        stats["residues_per_s"] = self.n_residues / elapsed
+        stats["peak_rss_mb"] = peak_rss_mb()
+        if self.cuda:
+            stats["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2.0 ** 20
+        self.totals = OrderedDict()
+        self.n_iters = 0
+        self.n_samples = 0
+        self.n_residues = 0
+        self.t_window = time.perf_counter()
+        self.t_pause = None
+        self.reset_peaks()
+        return stats
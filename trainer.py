@@ -0,0 +1,540 @@
+import os
+import copy
+import queue
+import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, IterableDataset, Subset
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
+import torch.nn as nn
+import torch.optim as optim
+from aa_code_utils import decode_seq
+from dataset import collate_graphs
+from candidate_index import graph_csr, knn_graph
+from sample_store import ScoreStore
+from telemetry import StageTimer
+from networks import FocalLoss, GeneratorMethods, quantize_model, sample_candidates, sampled_softmax_loss
+from distributed import is_distributed, is_main, rank, world_size, all_reduce_mean, all_reduce_sum, merge_logs
+
+
+def to_tensor(x, dtype=torch.float, device=None):
+    # a no-op for tensors that already have dtype and device, e.g. from datasets with float32_tensors=True
+    if x is None:
+        return None
+    if not torch.is_tensor(x):
+        x = torch.from_numpy(x)
+    # one copy at most, even when both dtype and device change
+    return x.to(device=device, dtype=dtype)
+
+
+def batch_loss(model, data, loss_fn, device=None, timer=None, sampled=None):
+    # model is a GeneratorMethods, possibly wrapped in DistributedDataParallel. sampled=(n_hard, n_random, gamma)
+    # scores every residue against sampled candidates only, with both directions in one pass
+    x, x_lens, f, f_lens, a_mat, gt_idxs, gt_idxs_rev = data
+    x_tensor = to_tensor(x, device=device)
+    f_tensor = to_tensor(f, device=device)
+    a_tensor = to_tensor(a_mat, device=device)
+    g_tensor = to_tensor(gt_idxs, dtype=torch.long, device=device)
+    g_rev_tensor = to_tensor(gt_idxs_rev, dtype=torch.long, device=device)
+    seq_lens = to_tensor(x_lens, device=device)
+    if timer is not None:
+        timer.lap("h2d")
+    if sampled is not None:
+        n_hard, n_random, gamma = sampled
+        res_b, res_i = torch.nonzero(g_tensor >= 0, as_tuple=True)
+        node_n = f_lens.to(g_tensor.device)
+        node_lo = (torch.cumsum(node_n, 0) - node_n)[res_b]
+        cand, dup, target_r = sample_candidates(node_lo + g_tensor[res_b, res_i], node_lo + g_rev_tensor[res_b, res_i],
+                                                node_lo, node_n[res_b], a_tensor, n_hard=n_hard, n_random=n_random)
+        if timer is not None:
+            timer.lap("candidates")
+        scores = model("forward_batch_sampled", x_tensor, x_lens, f_tensor, f_lens, a_tensor, res_b, res_i, cand)
+        if timer is not None:
+            timer.lap("forward")
+        return sampled_softmax_loss(scores, dup, target_r, res_b, len(x_lens), gamma=gamma)
+    scores, _ = model("forward_batch", x_tensor, x_lens, f_tensor, f_lens, a_tensor)
+    if timer is not None:
+        timer.lap("forward")
+    b, n, m = scores.size()
+    loss_f = loss_fn(scores.view(b * n, m), g_tensor.view(-1))
+    loss_r = loss_fn(scores.view(b * n, m), g_rev_tensor.view(-1))
+    loss_f = torch.sum(loss_f.view(b, n), dim=1) / seq_lens
+    loss_r = torch.sum(loss_r.view(b, n), dim=1) / seq_lens
+    return torch.mean(torch.min(loss_f, loss_r))
+
+
+def val_worker(model, dataset, jobs, results, n_threads=1, cpus=None):
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(n_threads)
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        key, state = job
+        try:
+            model.load_state_dict(state)
+            results.put((key, val(model, dataset), None))
+        except Exception as e:
+            results.put((key, None, repr(e)))
+
+
+class BackgroundValidator(object):
+    # runs val on snapshots of the model in a forked process while training goes on. the process starts with a CPU
+    # copy of the model and the validation set, so only state_dicts travel, through shared memory. when there are
+    # enough CPUs it gets the last n_threads of them and the trainer keeps the rest until close(). snapshots beyond
+    # max_pending unfinished ones are dropped unless forced
+
+    def __init__(self, model, dataset, n_threads=1, max_pending=2):
+        ctx = torch.multiprocessing.get_context("fork")
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.pending = 0
+        self.max_pending = max_pending
+        self.cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+        self.n_threads = torch.get_num_threads()
+        val_cpus = None
+        if self.cpus is not None and len(self.cpus) > n_threads:
+            val_cpus = self.cpus[-n_threads:]
+            os.sched_setaffinity(0, self.cpus[:-n_threads])
+            torch.set_num_threads(min(self.n_threads, len(self.cpus) - n_threads))
+        val_model = copy.deepcopy(model).cpu()
+        val_model.device = "cpu"
+        self.process = ctx.Process(target=val_worker, args=(val_model, dataset, self.jobs, self.results, n_threads,
+                                                            val_cpus), daemon=True)
+        self.process.start()
+
+    def submit(self, model, key, force=False):
+        if self.pending >= self.max_pending and not force:
+            return False
+        self.jobs.put((key, {k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()}))
+        self.pending += 1
+        return True
+
+    def poll(self, block=False):
+        # (key, acc) of the finished snapshots in submission order
+        done = list()
+        while self.pending > 0:
+            try:
+                key, acc, error = self.results.get(timeout=1.0) if block else self.results.get_nowait()
+            except queue.Empty:
+                if block and self.process.is_alive():
+                    continue
+                break
+            self.pending -= 1
+            if error is not None:
+                print("background validation of {} failed: {}".format(key, error))
+                continue
+            done.append((key, acc))
+        return done
+
+    def close(self):
+        done = self.poll(block=True)
+        self.jobs.put(None)
+        self.process.join()
+        if self.cpus is not None:
+            os.sched_setaffinity(0, self.cpus)
+        torch.set_num_threads(self.n_threads)
+        return done
+
+
+def log_background_val(log, done):
+    for (kind, epoch, seen), acc in done:
+        if kind == "val_seen":
+            log["val_seen"].append(dict(seen=seen, acc=acc))
+        else:
+            log["val"].append(dict(epoch=epoch, acc=acc))
+        print("seen {}, acc {:.4f} (background)".format(seen, acc))
+
+
+def train(model, dataset, val_dataset=None, n_epoch=1, lr=0.1, print_every=100, log_every=100, val_every=2000,
+          focalloss=None, batch_size=1, device=None, instrument=False, profile_iters=None, profile_trace=None,
+          num_workers=8, sampled_loss=False, n_hard=16, n_random=32, exact_epochs=0, async_val=False, val_threads=1,
+          verbose=False):
+    # instrument=True adds per-stage timings, throughput and peak memory to every log["train"] entry;
+    # profile_iters=(start, stop) records a torch.profiler trace of those global iterations into profile_trace.
+    # sampled_loss=True trains on a sampled softmax over the true nodes, n_hard neighbours of them and n_random
+    # random nodes per residue; the last exact_epochs epochs switch back to the exact loss over all nodes.
+    # inside an initialized process group the model is trained with DistributedDataParallel on this rank's shard
+    # of dataset, validation accuracy is averaged over ranks and the returned log is merged across ranks.
+    # async_val=True validates snapshots in a BackgroundValidator with val_threads threads (on the main rank only,
+    # over the whole validation set) and logs the results as they arrive
+    distributed = is_distributed()
+    if is_main():
+        print("====================== train ======================")
+    t0 = time.time()
+    log = dict(train=list(), val=list(), val_seen=list())
+    timer = StageTimer(enabled=instrument, device=device)
+    profiler = None
+    step = 0
+    if focalloss is not None:
+        loss_fn = FocalLoss(weight=None, gamma=focalloss, reduce=batch_size == 1)
+    elif batch_size > 1:
+        loss_fn = nn.CrossEntropyLoss(reduction="none", ignore_index=-1)
+    else:
+        loss_fn = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+    step_model = GeneratorMethods(model)
+    validator = None
+    if async_val and val_dataset is not None and is_main():
+        validator = BackgroundValidator(model, val_dataset, n_threads=val_threads)
+    sampler = None
+    if distributed:
+        on_cuda = device is not None and device.type == "cuda"
+        step_model = DistributedDataParallel(step_model, device_ids=[device] if on_cuda else None)
+        # iterable datasets shard themselves by rank
+        if not isinstance(dataset, IterableDataset):
+            sampler = DistributedSampler(dataset, shuffle=False)
+    if batch_size > 1:
+        dataloader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers,
+                                drop_last=False, collate_fn=collate_graphs, persistent_workers=num_workers > 0)
+    else:
+        dataloader = DataLoader(dataset, batch_size=None, sampler=sampler, num_workers=num_workers,
+                                persistent_workers=num_workers > 0)
+    for i in range(n_epoch):
+        t1 = time.time()
+        if sampler is not None:
+            sampler.set_epoch(i)
+        sampled = (n_hard, n_random, focalloss) if sampled_loss and i < n_epoch - exact_epochs else None
+        timer.start()
+        for j, data in enumerate(dataloader):
+            timer.lap("data")
+            if profile_iters is not None and step == profile_iters[0]:
+                profiler = torch.profiler.profile(record_shapes=True)
+                profiler.__enter__()
+            model.train()
+            model.zero_grad()
+            if batch_size > 1:
+                loss = batch_loss(step_model, data, loss_fn, device=device, timer=timer, sampled=sampled)
+                n_samples = len(data[1])
+                n_residues = int(torch.sum(data[1]))
+            else:
+                x, f, a_mat, d_mat, gt_idxs = data
+                if verbose:
+                    print("x", x.size(), "f", f.size(), "a_mat", a_mat.size(),
+                          "d_mat", None if d_mat is None else d_mat.size(), "gt_idxs", gt_idxs.size())
+                n = len(gt_idxs)
+                if verbose:
+                    print(j, list(gt_idxs), n)
+                x_tensor = to_tensor(x, device=device)
+                f_tensor = to_tensor(f, device=device)
+                a_tensor = to_tensor(a_mat, device=device)
+                d_tensor = to_tensor(d_mat, device=device)
+                g_tensor = to_tensor(gt_idxs, dtype=torch.long, device=device)
+                timer.lap("h2d")
+                if sampled is not None:
+                    zeros = torch.zeros_like(g_tensor)
+                    cand, dup, target_r = sample_candidates(g_tensor, torch.flip(g_tensor, (0, )), zeros,
+                                                            torch.full_like(g_tensor, f_tensor.size(0)), a_tensor,
+                                                            n_hard=n_hard, n_random=n_random)
+                    timer.lap("candidates")
+                    scores = step_model("forward_sampled", x_tensor, f_tensor, a_tensor, d_tensor, cand)
+                    timer.lap("forward")
+                    loss = sampled_softmax_loss(scores, dup, target_r, zeros, 1, gamma=focalloss)
+                else:
+                    scores, _ = step_model("forward", x_tensor, f_tensor, a_tensor, d_tensor)
+                    timer.lap("forward")
+                    loss_f = loss_fn(scores, g_tensor.long())
+                    loss_r = loss_fn(scores, torch.flip(g_tensor, (0, )).long())
+                    loss = torch.min(loss_f, loss_r)
+                n_samples = 1
+                n_residues = n
+            timer.lap("loss")
+            loss.backward()
+            timer.lap("backward")
+            optimizer.step()
+            timer.lap("optimizer")
+            timer.count(n_samples, n_residues)
+            if profiler is not None and step + 1 == profile_iters[1]:
+                profiler.__exit__(None, None, None)
+                profiler.export_chrome_trace(profile_trace)
+                print("profiler trace of iterations {}-{} written to {}".format(profile_iters[0], profile_iters[1],
+                                                                                profile_trace))
+                profiler = None
+            step += 1
+            with torch.no_grad():
+                model.seen += n_samples
+                if (j+1) % log_every == 0:
+                    entry = dict(epoch=i+1, iter=j+1, seen=model.seen, loss=loss.item())
+                    if instrument:
+                        entry["stages"] = timer.flush()
+                        if is_main():
+                            print(" ".join("{} {:.4g}".format(k, v) for k, v in entry["stages"].items()))
+                    log["train"].append(entry)
+                if (j+1) % print_every == 0 and is_main():
+                    print("epoch {} loss {:.4f}".format(i, loss.data))
+                if (j+1) % val_every == 0 and val_dataset is not None and async_val:
+                    seen = all_reduce_sum(model.seen)
+                    if validator is not None and not validator.submit(model, ("val_seen", i, seen)):
+                        print("background validation busy, skipping the snapshot at seen {}".format(seen))
+                elif (j+1) % val_every == 0:
+                    if val_dataset is not None:
+                        timer.pause()
+                        with torch.no_grad():
+                            val_acc = val_shard(model, val_dataset, device=device)
+                            seen = all_reduce_sum(model.seen)
+                            log["val_seen"].append(dict(seen=seen, acc=val_acc))
+                            t2 = time.time()
+                            eta = (t2 - t1) / float(j + 1) * float(len(dataloader) - j - 1)
+                            if is_main():
+                                print("seen {}, acc {:.4f}, {:.1f}s to go for this epoch".format(seen, val_acc, eta))
+            if validator is not None and validator.pending > 0:
+                log_background_val(log, validator.poll())
+            timer.start()
+        if val_dataset is not None and async_val:
+            seen = all_reduce_sum(model.seen)
+            if validator is not None:
+                validator.submit(model, ("val", i, seen), force=True)
+        elif val_dataset is not None:
+            timer.pause()
+            with torch.no_grad():
+                val_acc = val_shard(model, val_dataset, device=device)
+                seen = all_reduce_sum(model.seen)
+                log["val"].append(dict(epoch=i, acc=val_acc))
+                if is_main():
+                    print("seen {}, acc {:.4f}".format(seen, val_acc))
+        t2 = time.time()
+        eta = (t2-t0) / float(i+1) * float(n_epoch-i-1)
+        if is_main():
+            print("time elapsed {:.1f}s, {:.1f}s for this epoch, {:.1f}s to go".format(t2-t0, t2-t1, eta))
+            print("===================================================================================================")
+    if validator is not None:
+        log_background_val(log, validator.close())
+    if profiler is not None:
+        profiler.__exit__(None, None, None)
+        profiler.export_chrome_trace(profile_trace)
+        print("profiler trace from iteration {} written to {}".format(profile_iters[0], profile_trace))
+    if distributed:
+        model.seen = all_reduce_sum(model.seen)
+        log = merge_logs(log)
+    return model, log
+
+
+def val_shard(model, dataset, device=None):
+    # every rank validates every world_size-th sample and the accuracies are averaged weighted by shard size
+    if not is_distributed():
+        return val(model, dataset, device=device, verbose=False)
+    shard = Subset(dataset, range(rank(), len(dataset), world_size()))
+    acc = val(model, shard, device=device, verbose=False) if len(shard) > 0 else 0.0
+    return all_reduce_mean(acc, len(shard))
+
+
+def match_acc(labels, idxs, gt_idxs, rev_idxs=None):
+    # labels holds the residue type of every candidate node; rev_idxs are predictions for the reversed sequence,
+    # already flipped back, used where they fix a residue type the forward pass got wrong
+    if rev_idxs is not None:
+        mask = np.logical_and(labels[gt_idxs] == labels[rev_idxs], labels[gt_idxs] != labels[idxs])
+        idxs = np.where(mask, rev_idxs, idxs)
+    acc_f = np.sum(1 * (idxs == gt_idxs))
+    acc_r = np.sum(1 * (idxs == gt_idxs[::-1]))
+    return np.maximum(acc_f, acc_r) / float(len(gt_idxs)), idxs
+
+
+def val(model, dataset, device=None, verbose=False, reverse_seq=False, output=None, decoder=None):
+    # decoder (see decoder.py) replaces the per-residue argmax with a one-to-one assignment
+    acc_all = 0
+    model.eval()
+    store = None
+    if output is not None:
+        store = ScoreStore(os.path.join(output, "scores.h5"), mode="w")
+    with torch.no_grad():
+        for j in range(len(dataset)):
+            model.zero_grad()
+            x, f, a_mat, d_mat, gt_idxs = dataset[j]
+            gt_idxs = np.asarray(gt_idxs)
+            n = len(gt_idxs)
+            x_tensor = to_tensor(x, device=device)
+            f_tensor = to_tensor(f, device=device)
+            a_tensor = to_tensor(a_mat, device=device)
+            d_tensor = to_tensor(d_mat, device=device)
+            scores, idxs = model(x_tensor, f_tensor, a_tensor, d_tensor)
+            idxs = np.array(idxs.data.cpu()) if decoder is None else decoder(scores, a_mat)
+            rev_idxs = None
+            if reverse_seq:
+                rev_scores, rev_idxs = model(torch.flip(x_tensor, [0]), f_tensor, a_tensor, d_tensor)
+                rev_idxs = np.array(rev_idxs.data.cpu()) if decoder is None else decoder(rev_scores, a_mat)
+                rev_idxs = rev_idxs[::-1]
+            labels = torch.argmax(f_tensor, dim=1).cpu().numpy()
+            acc, idxs = match_acc(labels, idxs, gt_idxs, rev_idxs)
+            acc_all = acc_all + acc
+            if verbose:
+                print("GT", decode_seq(labels[gt_idxs]))
+                print("PR", decode_seq(labels[idxs]))
+                print("GT", list(gt_idxs), n)
+                print("PR", list(idxs), n)
+                print(j, acc)
+            if store is not None:
+                store.append(j, scores.data.cpu().numpy())
+    if store is not None:
+        store.close()
+    acc_all = acc_all / len(dataset)
+    if verbose:
+        print("overall acc:", acc_all)
+    return acc_all
+
+
+def reverse_batch(x, x_lens, f, f_lens, a_mat):
+    # appends every sample a second time with its sequence reversed and the same candidate graph
+    pos = torch.arange(x.size(0)).view(-1, 1)
+    rev_pos = torch.clamp(x_lens.view(1, -1) - 1 - pos, min=0)
+    x_rev = torch.gather(x, 0, rev_pos.unsqueeze(2).expand_as(x))
+    m = f.size(0)
+    a_mat = torch.sparse_coo_tensor(torch.cat((a_mat.indices(), a_mat.indices() + m), 1),
+                                    torch.cat((a_mat.values(), a_mat.values())), (2 * m, 2 * m), check_invariants=False)
+    return torch.cat((x, x_rev), 1), torch.cat((x_lens, x_lens)), torch.cat((f, f)), torch.cat((f_lens, f_lens)), a_mat
+
+
+def infer(model, dataset, batch_size=16, num_workers=4, device=None, reverse_seq=False, output=None, decoder=None):
+    # batched counterpart of val: samples are prefetched by DataLoader workers, forward and reversed sequences
+    # share one forward_batch call and scores are appended to a single ScoreStore keyed by dataset index
+    acc_all = 0
+    model.eval()
+    store = None
+    if output is not None:
+        store = ScoreStore(os.path.join(output, "scores.h5"), mode="w")
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                            collate_fn=collate_graphs)
+    t0 = time.time()
+    j = 0
+    with torch.no_grad():
+        for x, x_lens, f, f_lens, a_mat, gt_idxs, _ in dataloader:
+            b = len(x_lens)
+            inputs = (x, x_lens, f, f_lens, a_mat)
+            if reverse_seq:
+                inputs = reverse_batch(*inputs)
+            scores, idxs = model.forward_batch(to_tensor(inputs[0], device=device), inputs[1],
+                                               to_tensor(inputs[2], device=device), inputs[3],
+                                               to_tensor(inputs[4], device=device))
+            scores = scores.cpu().numpy()
+            idxs = idxs.cpu().numpy()
+            labels = torch.argmax(f, dim=1).numpy()
+            offsets = (torch.cumsum(f_lens, 0) - f_lens).tolist()
+            a_csr = graph_csr(a_mat) if decoder is not None and decoder.continuity else None
+            batch_scores = list()
+            for k in range(b):
+                n = int(x_lens[k])
+                m = int(f_lens[k])
+                if decoder is not None:
+                    # every sample is decoded on its own block of the batched graph
+                    block = None if a_csr is None else a_csr[offsets[k]:offsets[k] + m, offsets[k]:offsets[k] + m]
+                    idxs[k, :n] = decoder(scores[k, :n, :m], block)
+                    if reverse_seq:
+                        idxs[b + k, :n] = decoder(scores[b + k, :n, :m], block)
+                rev_idxs = idxs[b + k, :n][::-1] if reverse_seq else None
+                acc, _ = match_acc(labels[offsets[k]:offsets[k] + m], idxs[k, :n], gt_idxs[k, :n].numpy(), rev_idxs)
+                acc_all = acc_all + acc
+                batch_scores.append(scores[k, :n, :m])
+            if store is not None:
+                store.extend(range(j, j + b), batch_scores)
+            j += b
+    if store is not None:
+        store.close()
+    t1 = time.time()
+    print("inferred {} samples in {:.1f}s, {:.1f} samples/s".format(j, t1 - t0, j / max(t1 - t0, 1e-9)))
+    return acc_all / max(j, 1)
+
+
+def set_cpu_threads(n_threads=None):
+    # intra-op threads default to the CPUs this process may run on; inference runs one op at a time, so a single
+    # inter-op thread avoids oversubscription
+    if n_threads is None:
+        n_threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    torch.set_num_threads(n_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set before the first parallel op
+        pass
+    return n_threads
+
+
+def evaluate(model, dataset, device=None, batch_size=None, num_workers=4, verbose=False, reverse_seq=False,
+             output=None, decoder=None):
+    if batch_size is not None:
+        return infer(model, dataset, batch_size=batch_size, num_workers=num_workers, device=device,
+                     reverse_seq=reverse_seq, output=output, decoder=decoder)
+    return val(model, dataset, device=device, verbose=verbose, reverse_seq=reverse_seq, output=output,
+               decoder=decoder)
+
+
+def compare_quantized(model, dataset, batch_size=None, num_workers=4, reverse_seq=False, output=None, decoder=None):
+    # accuracy and latency of the fp32 model against its dynamic int8 copy, both on CPU; scores of the int8 model
+    # go to output if given
+    model = model.cpu()
+    model.device = "cpu"
+    q_model = quantize_model(model)
+    results = dict()
+    for name, m, out in (("fp32", model, None), ("int8", q_model, output)):
+        # the first calls compile the int8 pair scorer (see quantize_model) and are left out of the timing
+        warm = Subset(dataset, range(min(len(dataset), batch_size or 1)))
+        evaluate(m, warm, device=torch.device("cpu"), batch_size=batch_size, num_workers=0, reverse_seq=reverse_seq)
+        t0 = time.time()
+        acc = evaluate(m, dataset, device=torch.device("cpu"), batch_size=batch_size, num_workers=num_workers,
+                       reverse_seq=reverse_seq, output=out, decoder=decoder)
+        results[name] = dict(acc=acc, time=time.time() - t0)
+        print("{} acc {:.5f}, {:.2f}s for {} samples".format(name, acc, results[name]["time"], len(dataset)))
+    return q_model, results
+
+
+def compare_topk(model, dataset, k=32, seed_every=8, n_iter=16, device=None, output=None):
+    # accuracy and cost of forward_topk against the exact forward on the same samples: pairs scored, agreement of
+    # the assignments and time, with the neighbour index built from each sample's graph timed separately. sparse
+    # top-k scores go to output if given, densified with -inf for the pairs never scored
+    model.eval()
+    store = None
+    if output is not None:
+        store = ScoreStore(os.path.join(output, "scores.h5"), mode="w")
+    totals = dict(acc_exact=0.0, acc_topk=0.0, agree=0, n_res=0, pairs_exact=0, pairs_topk=0, time_exact=0.0,
+                  time_index=0.0, time_topk=0.0, n_nbrs=0, n_nodes=0)
+    with torch.no_grad():
+        for j in range(len(dataset)):
+            x, f, a_mat, d_mat, gt_idxs = dataset[j]
+            gt_idxs = np.asarray(gt_idxs)
+            x_tensor = to_tensor(x, device=device)
+            f_tensor = to_tensor(f, device=device)
+            a_tensor = to_tensor(a_mat, device=device)
+            d_tensor = to_tensor(d_mat, device=device)
+            t0 = time.time()
+            _, idxs = model(x_tensor, f_tensor, a_tensor, d_tensor)
+            idxs = idxs.cpu().numpy()
+            t1 = time.time()
+            nbrs = torch.from_numpy(knn_graph(a_mat, k)).to(f_tensor.device)
+            t2 = time.time()
+            totals["n_nbrs"] += int(torch.sum(nbrs >= 0))
+            totals["n_nodes"] += nbrs.size(0)
+            scores, topk_idxs, n_scored = model.forward_topk(x_tensor, f_tensor, a_tensor, d_tensor, nbrs,
+                                                             seed_every, n_iter)
+            topk_idxs = topk_idxs.cpu().numpy()
+            t3 = time.time()
+            labels = torch.argmax(f_tensor, dim=1).cpu().numpy()
+            n, m = len(gt_idxs), f_tensor.size(0)
+            totals["acc_exact"] += match_acc(labels, idxs, gt_idxs)[0]
+            totals["acc_topk"] += match_acc(labels, topk_idxs, gt_idxs)[0]
+            totals["agree"] += int(np.sum(idxs == topk_idxs))
+            totals["n_res"] += n
+            totals["pairs_exact"] += n * m
+            totals["pairs_topk"] += n_scored
+            totals["time_exact"] += t1 - t0
+            totals["time_index"] += t2 - t1
+            totals["time_topk"] += t3 - t2
+            if store is not None:
+                dense = torch.full(scores.size(), float("-inf"))
+                dense[tuple(scores.indices().cpu())] = scores.values().cpu()
+                store.append(j, dense.numpy())
+    if store is not None:
+        store.close()
+    n_samples = max(len(dataset), 1)
+    results = dict(acc_exact=totals["acc_exact"] / n_samples, acc_topk=totals["acc_topk"] / n_samples,
+                   agreement=totals["agree"] / float(max(totals["n_res"], 1)),
+                   pairs_exact=totals["pairs_exact"], pairs_topk=totals["pairs_topk"],
+                   time_exact=totals["time_exact"], time_index=totals["time_index"], time_topk=totals["time_topk"],
+                   mean_nbrs=totals["n_nbrs"] / float(max(totals["n_nodes"], 1)))
+    print("exact acc {:.5f}, {} pairs, {:.2f}s".format(results["acc_exact"], results["pairs_exact"],
+                                                        results["time_exact"]))
+    print("top-{} acc {:.5f}, {} pairs ({:.1%}), {:.2f}s + {:.2f}s index".format(
+        k, results["acc_topk"], results["pairs_topk"], results["pairs_topk"] / float(max(results["pairs_exact"], 1)),
+        results["time_topk"], results["time_index"]))
+    print("top-{} index holds {:.1f} neighbours per node on average".format(k, results["mean_nbrs"]))
+    print("top-{} agrees with exact on {:.1%} of {} residues".format(k, results["agreement"], totals["n_res"]))
+    return results